@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Generate a synthetic bookmark database for benchmarks
+
+Usage: corpus.py DATABASE NUM_MARKS [SEED]
+
+Marks belong to topics of Zipf-distributed popularity, which share title and
+note words and tags, so similarity search and tag suggestions have something
+to find. Tags, words and hosts are Zipf-distributed as well. Notes are
+markdown, some with crosslinks to older marks, external links, lists and
+`loc:` geo locations. The same NUM_MARKS and SEED always give the same marks.
+
+The marks are written to an export.xml file and loaded with import_xml(),
+the similarity cache is not built.
+"""
+
+import itertools
+import os
+import random
+import sys
+import tempfile
+from xml.sax.saxutils import quoteattr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from kb3 import tagbase
+
+# Bump when the generated marks change, so cached corpora are regenerated.
+CORPUS_VERSION = 1
+USER = 'bench'
+ABS_URL_PREFIX = 'http://localhost/' + USER
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'pa', 'qu', 'ber', 'don', 'fel',
+             'gar', 'hin', 'jor', 'kel', 'lin', 'mor', 'nus', 'por', 'ras', 'sil', 'tor', 'ul', 'ä', 'ö']
+FIRST_TIME = 1262304000     # 2010-01-01
+
+
+def _words(rnd, num, min_syllables, max_syllables):
+    words = set()
+    while len(words) < num:
+        words.add(''.join(rnd.choices(SYLLABLES, k=rnd.randint(min_syllables, max_syllables))))
+    return sorted(words)
+
+
+class _Zipf:
+    """Random choice from `items`, the item at rank r has weight 1 / r**s"""
+
+    def __init__(self, rnd, items, s=1.0):
+        self.rnd = rnd
+        self.items = items
+        self.cum_weights = list(itertools.accumulate(1 / r**s for r in range(1, len(items) + 1)))
+
+    def __call__(self, k=1):
+        return self.rnd.choices(self.items, cum_weights=self.cum_weights, k=k)
+
+
+class CorpusGenerator:
+    def __init__(self, num_marks, seed=0):
+        self.num_marks = num_marks
+        self.rnd = rnd = random.Random(seed)
+        vocabulary = _words(rnd, 20000, 2, 4)
+        rnd.shuffle(vocabulary)
+        self.word = _Zipf(rnd, vocabulary)
+        tags = _words(rnd, min(max(100, num_marks // 20), 20000), 1, 3)
+        rnd.shuffle(tags)
+        self.tag = _Zipf(rnd, tags, s=1.1)
+        self.host = _Zipf(rnd, [f"{w}.{rnd.choice(['com', 'org', 'net', 'de'])}"
+                                for w in _words(rnd, max(50, num_marks // 10), 2, 3)])
+        num_topics = min(max(20, num_marks // 200), 5000)
+        self.topic = _Zipf(rnd, [(rnd.sample(vocabulary, 40), self.tag(rnd.randint(1, 3)))
+                                 for _ in range(num_topics)])
+        self.urls = []
+
+    def text(self, topic_words, num_words):
+        rnd = self.rnd
+        words = self.word(num_words)
+        for i in range(0, num_words, 3):
+            words[i] = rnd.choice(topic_words)
+        return ' '.join(words)
+
+    def note(self, mark_id, topic_words):
+        rnd = self.rnd
+        if rnd.random() < 0.2:
+            return ''
+        paragraphs = [self.text(topic_words, rnd.randint(10, 60)).capitalize() + '.'
+                      for _ in range(rnd.randint(1, 4))]
+        if mark_id > 1 and rnd.random() < 0.15:
+            dest_id = rnd.randint(max(1, mark_id - 5000), mark_id - 1)
+            paragraphs.append(f"See also [{self.text(topic_words, 3)}](/{USER}/mark.{dest_id}).")
+        if rnd.random() < 0.1:
+            paragraphs.append(f"[{self.text(topic_words, 2)}](https://{self.host()[0]}/{self.word()[0]})")
+        if rnd.random() < 0.1:
+            paragraphs.append('\n'.join(f"* {self.text(topic_words, rnd.randint(2, 8))}"
+                                        for _ in range(rnd.randint(2, 5))))
+        if rnd.random() < 0.03:
+            paragraphs.append(f"loc:{rnd.uniform(-60, 70):.5f},{rnd.uniform(-180, 180):.5f} "
+                              f"{self.text(topic_words, 2).title()}")
+        return '\n\n'.join(paragraphs)
+
+    def mark(self, mark_id):
+        rnd = self.rnd
+        topic_words, topic_tags = self.topic()[0]
+        tags = dict.fromkeys(topic_tags[:rnd.randint(1, len(topic_tags))] + self.tag(rnd.randint(0, 2)))
+        if rnd.random() < 0.05:
+            tags[f"{rnd.randint(0, 5)}star"] = None
+        if self.urls and rnd.random() < 0.02:
+            url = rnd.choice(self.urls)
+        else:
+            url = f"https://{self.host()[0]}/{self.word()[0]}/{'-'.join(self.word(rnd.randint(1, 3)))}"
+            self.urls.append(url)
+        return dict(
+            id=str(mark_id),
+            href=url,
+            description=self.text(topic_words, rnd.randint(2, 8)).title(),
+            tag=' '.join(tags),
+            time=str(FIRST_TIME + mark_id * 3600 + rnd.randint(0, 3599)),
+            extended=self.note(mark_id, topic_words),
+        )
+
+    def write_xml(self, f):
+        """Write all marks in export.xml format, newest first as import_xml() expects
+
+        Marks are generated oldest first, so crosslinks only point to older
+        marks, and buffered in between.
+        """
+        posts = [self.mark(mark_id) for mark_id in range(1, self.num_marks + 1)]
+        f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<posts user="{USER}" tag="">\n')
+        for post in reversed(posts):
+            f.write('    <post ' + ' '.join(f'{k}={quoteattr(v)}' for k, v in post.items()) + ' />\n')
+        f.write('</posts>\n')
+
+
+def generate(dbfname, num_marks, seed=0, *, progress=None):
+    """Create the database `dbfname` with `num_marks` synthetic marks"""
+    if os.path.exists(dbfname):
+        raise FileExistsError(dbfname)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        xml_fname = os.path.join(tmpdir, 'corpus.xml')
+        with open(xml_fname, 'w', encoding='utf-8') as f:
+            CorpusGenerator(num_marks, seed).write_xml(f)
+        db = tagbase.BookmarkDB(dbfname, ABS_URL_PREFIX)
+        try:
+            db.import_xml(xml_fname, batch_size=5000, progress=progress)
+            # Like a DB in use for a while, which has planner statistics from PRAGMA optimize.
+            db.dbconn.executescript("ANALYZE; VACUUM;")
+        finally:
+            db.close()
+
+
+def cached_corpus(directory, num_marks, seed=0, *, progress=None):
+    """Return the file name of a corpus in `directory`, generating it if needed"""
+    dbfname = os.path.join(directory, f"corpus-v{CORPUS_VERSION}-{num_marks}-{seed}.db")
+    if not os.path.exists(dbfname):
+        os.makedirs(directory, exist_ok=True)
+        tmp_fname = f"{dbfname}.{os.getpid()}.tmp"
+        generate(tmp_fname, num_marks, seed, progress=progress)
+        os.replace(tmp_fname, dbfname)
+    return dbfname
+
+
+def main():
+    if not 3 <= len(sys.argv) <= 4:
+        sys.exit(__doc__)
+    generate(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]) if len(sys.argv) > 3 else 0,
+             progress=lambda n: print(f"{n} marks imported", file=sys.stderr))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Show query plans and timings of common queries without and with the indexes of schema version 2
+
+Usage: query_plans.py DATABASE
+
+Works on a copy of DATABASE, the file itself is left untouched.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from kb3 import tagbase
+
+V2_INDEXES = ('mark_tags_tag_id', 'marks_url', 'mark_crosslinks_destination_id')
+
+
+def traced(db, fn):
+    """Run `fn` and return the SQL statements it executed, with parameters filled in"""
+    statements = []
+    db.dbconn.set_trace_callback(statements.append)
+    try:
+        fn()
+    finally:
+        db.dbconn.set_trace_callback(None)
+    return [s for s in statements if s.lstrip().upper().startswith('SELECT')]
+
+
+def timed(fn, repeat=20):
+    t = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t) / repeat
+
+
+def report(db, cases):
+    for name, fn in cases:
+        print(f"--- {name}: {timed(fn) * 1000:.2f} ms")
+        for stmt in traced(db, fn):
+            for _, parent, _, detail in db.dbconn.execute("EXPLAIN QUERY PLAN " + stmt):
+                print(f"    {parent:3} {detail}")
+            print()
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbfname = os.path.join(tmpdir, 'bench.db')
+        shutil.copyfile(sys.argv[1], dbfname)
+        db = tagbase.BookmarkDB(dbfname, 'http://localhost/bench')
+
+        tag = db.dbconn.execute("""SELECT tag FROM tags JOIN mark_tags USING (tag_id)
+                                   GROUP BY tag_id ORDER BY count(*) DESC LIMIT 1;""").fetchone()[0]
+        url = db.dbconn.execute("SELECT url FROM marks ORDER BY mark_id LIMIT 1;").fetchone()[0]
+        marks = db.get_marks(limit=100)
+        cases = [
+            (f"get_marks(tag={tag!r}, limit=100)", lambda: db.get_marks(tag=tag, limit=100)),
+            (f"get_marks(url={url!r})", lambda: db.get_marks(url=url)),
+            ("_add_incoming_links(100 marks)", lambda: db._add_incoming_links(marks)),
+        ]
+
+        db.dbconn.executescript(''.join(f"DROP INDEX {name};" for name in V2_INDEXES))
+        print("=== Without the indexes of schema version 2\n")
+        report(db, cases)
+
+        db.dbconn.executescript(db.SCHEMA_MIGRATIONS[1])
+        print("=== With the indexes of schema version 2\n")
+        report(db, cases)
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
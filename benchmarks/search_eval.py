@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Compare the per-mark cost of evaluating search queries, before and after compiling them
+
+Usage: search_eval.py DATABASE [QUERY...]
+
+For each query, all marks of DATABASE are checked once with the RPN stack
+machine of SearchStrParser.evaluate() and Bookmark.contains(), as the search
+view used to do, and once with the compiled predicate behind the py_search()
+SQL function. Both work on already lowercased fields, so only evaluation is
+timed; "+prep" adds lowercasing and splitting the fields of the SQL row, which
+py_search() does for every row. Parsing is timed with and without the
+parsed-query cache.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from kb3 import tagbase
+from kb3.search import SearchStrParser, parse_query
+
+DEFAULT_QUERIES = ['abc', 'tag:python web', 'abc | xyz', '!abc', '(foo | bar) & !tag:old', 'a b c d', '"a b"']
+
+
+def evaluate_rpn(search, marks):
+    def contains(needle, mark):
+        if needle.startswith('tag:'):
+            return needle[4:] in mark.tags
+        else:
+            return mark.contains(needle)
+    return [m.id for m in marks if search.evaluate(callback=lambda needle: contains(needle, m))]
+
+
+def evaluate_compiled(query, marks, fields):
+    predicate = tagbase.search_predicate(query)
+    return [m.id for m, f in zip(marks, fields) if predicate(f)]
+
+
+def evaluate_sql_rows(query, rows):
+    return [row.id for row in rows if tagbase._py_search(query, row.title, row.url, row.note, row.tags)]
+
+
+def timed(f, *args):
+    t = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - t
+
+
+def per_call(f, num):
+    t = time.perf_counter()
+    for _ in range(num):
+        f()
+    return (time.perf_counter() - t) / num
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    db = tagbase.BookmarkDB(sys.argv[1], 'http://localhost/bench')
+    rows = list(db.iter_marks())
+    marks = [tagbase.Bookmark(id=row.id, title=row.title or '', url=row.url, note=row.note or '',
+                              tags=row.tags.split(' ')) for row in rows]
+    db.close()
+    fields = [(m.title.lower(), m.url.lower(), m.note.lower(), m.tags, ' '.join(m.tags).lower()) for m in marks]
+    for m in marks:
+        m.contains('')   # Fills the cache of lowercased fields.
+
+    print(f"{len(rows)} marks")
+    print(f"{'query':<24} {'matches':>8} {'rpn ns/mark':>12} {'compiled':>9} {'+prep':>7} "
+          f"{'parse us':>9} {'cached':>7}")
+    for query in sys.argv[2:] or DEFAULT_QUERIES:
+        expected, rpn = timed(evaluate_rpn, SearchStrParser(query), marks)
+        found, compiled = timed(evaluate_compiled, query, marks, fields)
+        found_sql, sql_rows = timed(evaluate_sql_rows, query, rows)
+        if not expected == found == found_sql:
+            sys.exit(f"Results differ for {query!r}")
+
+        parse = per_call(lambda: SearchStrParser(query), 1000)
+        cached = per_call(lambda: parse_query(query), 1000)
+        print(f"{query:<24} {len(found):>8} {rpn / len(rows) * 1e9:>12.0f} {compiled / len(rows) * 1e9:>9.0f} "
+              f"{sql_rows / len(rows) * 1e9:>7.0f} {parse * 1e6:>9.1f} {cached * 1e6:>7.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Time the cold start of a worker, from interpreter start to its first responses
+
+Usage: startup.py [--size 10000] [--runs 5] [--data-dir DIR]
+
+Each run starts a fresh Python process, which imports kb3, creates the app
+and requests, in this order, the index page, the first page of marks and
+the form for a new mark, which shows similar marks and suggested tags.
+Runs are made without and with the PRELOAD config setting; with it,
+create_app() takes longer and the requests find everything loaded, as they
+would in workers forked after create_app().
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+
+PHASES = ['import kb3', 'create_app', 'GET /', 'GET /<user>', 'GET /<user>/new', 'process']
+
+
+def child(data_dir, preload):
+    """Run in the timed process: print the seconds of each phase as JSON"""
+    timings = {}
+    t = time.perf_counter()
+    from kb3 import create_app
+    timings['import kb3'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    app = create_app(dict(
+        BASE_DIR=data_dir,
+        USERS_FILE=os.path.join(data_dir, 'users.json'),
+        ABS_ROOT_URL='http://localhost/',
+        PAGE_SIZE=25,
+        PRELOAD=preload,
+        SIMILARITY_REFRESH_DEBOUNCE=1e9,
+        SIMILARITY_REFRESH_MAX_STALENESS=1e9,
+    ))
+    timings['create_app'] = time.perf_counter() - t
+
+    client = app.test_client()
+    for name, path, query_string in [('GET /', '/', {}),
+                                     ('GET /<user>', '/bench', {}),
+                                     ('GET /<user>/new', '/bench/new', dict(title='Startup benchmark',
+                                                                            url='https://example.com/startup'))]:
+        t = time.perf_counter()
+        response = client.get(path, query_string=query_string)
+        response.get_data()
+        timings[name] = time.perf_counter() - t
+        assert response.status_code == 200, (path, response.status_code)
+    print(json.dumps(timings))
+
+
+def run(data_dir, preload):
+    t = time.perf_counter()
+    args = [sys.executable, os.path.abspath(__file__), '--child', data_dir] + (['--preload'] if preload else [])
+    output = subprocess.run(args, check=True, stdout=subprocess.PIPE, text=True).stdout
+    timings = json.loads(output)
+    timings['process'] = time.perf_counter() - t
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=10000, help="Marks of the benchmark corpus")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--data-dir', default=os.path.join(BENCHMARKS_DIR, 'data'),
+                        help="Where generated corpora are kept")
+    parser.add_argument('--child', metavar='DIR', help=argparse.SUPPRESS)
+    parser.add_argument('--preload', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child, args.preload)
+        return
+
+    # Not imported at the top, the timed child processes must import kb3 themselves.
+    import corpus
+    from kb3 import tagbase
+    source = corpus.cached_corpus(args.data_dir, args.size, args.seed,
+                                  progress=lambda n: print(f"generating: {n} marks imported", file=sys.stderr))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbfname = os.path.join(tmpdir, 'bench.db')
+        shutil.copyfile(source, dbfname)
+        with open(os.path.join(tmpdir, 'users.json'), 'w') as f:
+            json.dump([dict(name=corpus.USER, database='bench.db')], f)
+        # The similarity cache is up to date, as in a server that has been running for a while.
+        db = tagbase.BookmarkDB(dbfname, corpus.ABS_URL_PREFIX, refresh_debounce=1e9, refresh_max_staleness=1e9)
+        try:
+            db.update_similarity_cache()
+        finally:
+            db.close()
+
+        print(f"{args.size} marks, median of {args.runs} runs, ms")
+        print(f"{'':<10}" + ''.join(f"{phase:>17}" for phase in PHASES))
+        for preload in (False, True):
+            runs = [run(tmpdir, preload) for _ in range(args.runs)]
+            print(f"{'preload' if preload else 'default':<10}" +
+                  ''.join(f"{statistics.median(r[phase] for r in runs) * 1000:>17.1f}" for phase in PHASES))
+
+
+if __name__ == '__main__':
+    main()
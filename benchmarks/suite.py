@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""Time common operations on synthetic databases of several sizes
+
+Usage: suite.py [--sizes 1000,10000,100000] [--output results.json] [--compare OLD.json]
+
+Corpora are generated by corpus.py once and kept in --data-dir. Each run
+works on a copy, so writes don't change them. Timings are written to
+--output as JSON, together with the git commit they were measured on; with
+--compare, each timing is printed next to the one in an earlier result file,
+and the exit status is 1 if any got slower by more than --threshold.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import corpus
+from kb3 import create_app, tagbase
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+# Differences below this many seconds are noise, not regressions.
+MIN_DIFFERENCE = 1e-4
+# `{tag}` is replaced by the most frequent tag, timings are reported under the unreplaced query.
+SEARCH_QUERIES = ['ka', 'kaneäsil', 'tag:{tag}', 'lo | ne', '!zzz', 'loc:']
+
+
+def measure(fn, min_time, max_runs):
+    """Call `fn` once to warm up, then repeatedly for at least `min_time` seconds, return the run times"""
+    fn()
+    times = []
+    start = time.perf_counter()
+    while len(times) < max_runs and (not times or time.perf_counter() - start < min_time):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return times
+
+
+def git_commit():
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=BENCHMARKS_DIR, capture_output=True, text=True).stdout.strip()
+    return dict(commit=git('rev-parse', 'HEAD') or None, dirty=bool(git('status', '--porcelain', '--', '../kb3')))
+
+
+def make_app(tmpdir, dbfname):
+    users_fname = os.path.join(tmpdir, 'users.json')
+    with open(users_fname, 'w') as f:
+        json.dump([dict(name=corpus.USER, database=os.path.basename(dbfname))], f)
+    return create_app(dict(
+        BASE_DIR=os.path.dirname(dbfname),
+        USERS_FILE=users_fname,
+        ABS_ROOT_URL='http://localhost/',
+        PAGE_SIZE=25,
+        # Every request renders its page, instead of timing the render cache.
+        RENDER_CACHE_SIZE=0,
+        SIMILARITY_REFRESH_DEBOUNCE=1e9,
+        SIMILARITY_REFRESH_MAX_STALENESS=1e9,
+    ))
+
+
+def cases(db, client):
+    """Yield (name, function, is_slow) of everything to time on `db`"""
+    tags = [row[0] for row in db.dbconn.execute("SELECT tag FROM tags ORDER BY num_marks DESC, tag;")]
+    # The most frequent tag and one used by a few percent of the marks.
+    top_tag, mid_tag = tags[0], tags[min(20, len(tags) - 1)]
+    num_marks = db.dbconn.execute("SELECT count(*) FROM marks;").fetchone()[0]
+    mark = db.get_marks(offset=num_marks // 2, limit=1)[0]
+
+    def get(path, **query_string):
+        response = client.get(path, query_string=query_string)
+        assert response.status_code == 200, (path, response.status_code)
+        # Streamed responses only do their work while being read.
+        response.get_data()
+        response.close()
+
+    yield 'get_marks first page', lambda: db.get_marks(limit=25), False
+    yield 'get_marks middle page', lambda: db.get_marks(before_id=mark.id, limit=25), False
+    yield 'get_marks top tag', lambda: db.get_marks(tag=top_tag, limit=25), False
+    yield 'get_marks mid tag', lambda: db.get_marks(tag=mid_tag, limit=25), False
+    yield 'get_marks url', lambda: db.get_marks(url=mark.url), False
+    yield 'get_tags', lambda: list(db.get_tags()), False
+    yield 'get_tags by frequency', lambda: list(db.get_tags(sort_by_frequency=True)), False
+    for query in SEARCH_QUERIES:
+        yield (f'search_view q={query}',
+               lambda query=query.format(tag=top_tag): get(f'/{corpus.USER}/search', q=query), False)
+    yield 'list_view', lambda: get(f'/{corpus.USER}'), False
+    yield 'mark_view', lambda: get(f'/{corpus.USER}/mark.{mark.id}'), False
+    yield 'find_similar', lambda: db.find_similar(mark), False
+    yield 'find_similar draft', lambda: db.find_similar(tagbase.Bookmark(
+        title=mark.title, url=mark.url, note=mark.note + ' draft', tags=mark.tags)), False
+    yield 'find_similar_and_suggest_tags draft', lambda: db.find_similar_and_suggest_tags(tagbase.Bookmark(
+        title=mark.title, url=mark.url, note=mark.note + ' draft', tags=mark.tags)), False
+
+    def add_edit():
+        mark_id = db.add(title='Benchmark mark', url='https://example.com/bench',
+                         note='A new mark, see [this](/bench/mark.1).', tags=['bench', top_tag])
+        new_mark = db.get_marks(mark_id=mark_id)[0]
+        db.edit(new_mark, title='Benchmark mark, edited', tags=['bench', mid_tag])
+        db.delete(new_mark)
+    yield 'add+edit+delete', add_edit, False
+    yield 'export_view', lambda: get(f'/{corpus.USER}/export.xml'), True
+
+    def refresh_incremental():
+        db.edit(mark, note=mark.note + ' edited')
+        db._refresh_similarity_cache()
+    yield '_refresh_similarity_cache incremental', refresh_incremental, True
+
+
+def run_size(num_marks, args):
+    """Return the timings of all cases on a corpus of `num_marks` marks"""
+    source = corpus.cached_corpus(args.data_dir, num_marks, args.seed,
+                                  progress=lambda n: print(f"  generating: {n} marks imported", file=sys.stderr))
+    results = {}
+
+    def record(name, times):
+        results[name] = dict(min=min(times), median=statistics.median(times), runs=len(times))
+        print(f"  {name:<45} {results[name]['median'] * 1000:10.2f} ms  ({len(times)} runs)", file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbfname = os.path.join(tmpdir, 'bench.db')
+        shutil.copyfile(source, dbfname)
+        app = make_app(tmpdir, dbfname)
+        client = app.test_client()
+        db = tagbase.BookmarkDB(dbfname, corpus.ABS_URL_PREFIX,
+                                refresh_debounce=1e9, refresh_max_staleness=1e9)
+        try:
+            # A full refit, which also builds the similarity cache the other cases use.
+            t = time.perf_counter()
+            db._refresh_similarity_cache()
+            record('_refresh_similarity_cache refit', [time.perf_counter() - t])
+
+            for name, fn, slow in cases(db, client):
+                if slow:
+                    record(name, measure(fn, 0, args.slow_runs))
+                else:
+                    record(name, measure(fn, args.min_time, args.max_runs))
+        finally:
+            db.close()
+            app.extensions['db_pool'].close_all()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the timings next to those of `baseline`, return the number of regressions"""
+    regressions = 0
+    for size, cases in results.items():
+        for name, timing in cases.items():
+            old = baseline.get(size, {}).get(name)
+            if old is None:
+                continue
+            ratio = timing['median'] / old['median']
+            flag = ''
+            if abs(timing['median'] - old['median']) < MIN_DIFFERENCE:
+                pass
+            elif ratio > threshold:
+                flag = '  SLOWER'
+                regressions += 1
+            elif ratio < 1 / threshold:
+                flag = '  faster'
+            print(f"{size:>8} {name:<45} {old['median'] * 1000:10.2f} -> {timing['median'] * 1000:10.2f} ms "
+                  f"{ratio:6.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help="Comma-separated numbers of marks, e.g. 1000,10000,100000,1000000")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join(BENCHMARKS_DIR, 'data'),
+                        help="Where generated corpora are kept")
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--min-time', type=float, default=1.0, help="Seconds to repeat each fast case")
+    parser.add_argument('--max-runs', type=int, default=100)
+    parser.add_argument('--slow-runs', type=int, default=3, help="Runs of exports and similarity refreshes")
+    parser.add_argument('--compare', metavar='OLD_JSON', help="Earlier result file to compare with")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="Ratio of medians counted as a regression by --compare")
+    args = parser.parse_args()
+
+    results = {}
+    for num_marks in (int(s) for s in args.sizes.split(',')):
+        print(f"{num_marks} marks:", file=sys.stderr)
+        results[str(num_marks)] = run_size(num_marks, args)
+
+    with open(args.output, 'w') as f:
+        json.dump(dict(
+            **git_commit(),
+            date=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            python=platform.python_version(),
+            sqlite=sqlite3.sqlite_version,
+            machine=platform.platform(),
+            corpus_version=corpus.CORPUS_VERSION,
+            seed=args.seed,
+            results=results,
+        ), f, indent=2)
+        f.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('corpus_version') != corpus.CORPUS_VERSION or baseline.get('seed') != args.seed:
+            print("Warning: comparing timings of different corpora", file=sys.stderr, flush=True)
+        if compare(results, baseline['results'], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
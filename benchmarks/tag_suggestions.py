@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Measure precision, recall and latency of tag suggestions on held-out marks
+
+Usage: tag_suggestions.py DATABASE [NUM_HELD_OUT [NUM_SUGGESTIONS]]
+
+Works on a copy of DATABASE: a random sample of marks is deleted from it and
+the similarity cache is rebuilt without them. Then tags are suggested for
+each held-out mark, once from title, URL and note alone, and once when its
+first tag is already given.
+"""
+
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from kb3 import tagbase
+
+
+def evaluate(db, marks, num, given):
+    hits = num_suggested = num_expected = 0
+    latencies = []
+    for mark in marks:
+        expected = {t.lower() for t in mark.tags[given:]}
+        draft = tagbase.Bookmark(title=mark.title, url=mark.url, note=mark.note, tags=mark.tags[:given])
+        t = time.perf_counter()
+        suggested = db.suggest_tags(draft, num=num)
+        latencies.append(time.perf_counter() - t)
+        hits += len(expected & {t.lower() for t in suggested})
+        num_suggested += len(suggested)
+        num_expected += len(expected)
+    latencies.sort()
+    print(f"{given} tag(s) given: precision {hits / max(num_suggested, 1):.3f}, "
+          f"recall {hits / max(num_expected, 1):.3f}, "
+          f"latency median {statistics.median(latencies) * 1000:.2f} ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.2f} ms")
+
+
+def main():
+    if not 2 <= len(sys.argv) <= 4:
+        sys.exit(__doc__)
+    num_held_out = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    num = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbfname = os.path.join(tmpdir, 'bench.db')
+        shutil.copyfile(sys.argv[1], dbfname)
+
+        db = tagbase.BookmarkDB(dbfname, 'http://localhost/bench')
+        mark_ids = [row[0] for row in db.dbconn.execute("SELECT mark_id FROM marks;")]
+        held_out = db.get_marks(mark_ids=random.Random(0).sample(mark_ids, min(num_held_out, len(mark_ids))))
+        db.dbconn.execute("DELETE FROM marks WHERE mark_id IN (SELECT value FROM json_each(?));",
+                          (json.dumps([m.id for m in held_out]),))
+        db.cache.invalidate()
+        t = time.perf_counter()
+        db.update_similarity_cache()
+        print(f"Similarity cache for {len(mark_ids) - len(held_out)} marks built in {time.perf_counter() - t:.1f} s")
+
+        print(f"{len(held_out)} held-out marks, {num} suggestions each:")
+        evaluate(db, held_out, num, given=0)
+        evaluate(db, [m for m in held_out if len(m.tags) > 1], num, given=1)
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -16,8 +16,21 @@ def create_app(test_config=None):
         app.config['USERS'] = {u['name']: u for u in json.load(f)}
 
     from . import bookmarks
+    from .dbpool import DBPool
+    app.extensions['db_pool'] = DBPool(bookmarks.open_database,
+                                       max_size=app.config.get('DB_POOL_SIZE', 32),
+                                       idle_timeout=app.config.get('DB_POOL_IDLE_TIMEOUT', 300))
+    from .rendercache import RenderCache
+    app.extensions['render_cache'] = RenderCache(max_bytes=app.config.get('RENDER_CACHE_SIZE', 32 * 1024 * 1024),
+                                                 directory=app.config.get('RENDER_CACHE_DIR'))
     app.register_blueprint(bookmarks.bp)
+    from . import commands
+    commands.init_app(app)
+    from . import metrics
+    metrics.init_app(app)
     app.add_url_rule('/', endpoint='index')
+    if app.config.get('PRELOAD'):
+        bookmarks.preload_databases(app)
 
     if app.config.get('PROFILE'):
         from wsgi_lineprof.middleware import LineProfilerMiddleware
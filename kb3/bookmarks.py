@@ -1,17 +1,25 @@
 import os
+from datetime import datetime, timezone
 import functools
+import json
 import re
 import time
 import types
+import zlib
 
-from flask import Blueprint, flash, g, redirect, render_template, request, url_for, current_app
+from flask import (Blueprint, flash, g, jsonify, redirect, render_template, request, url_for, current_app,
+                   stream_template, stream_with_context)
+from markupsafe import Markup
 from werkzeug.exceptions import abort
+from werkzeug.http import is_resource_modified
 
 from . import tagbase
-from .search import SearchStrParser
+from .search import SearchStrParser, parse_query
 
 BLACKSTAR = "\u2605"
 WHITESTAR = "\u2606"
+# Most similar marks similar.json returns per mark.
+MAX_SIMILAR = 100
 
 
 @functools.lru_cache(maxsize=2048)
@@ -22,6 +30,103 @@ def format_date(mark_time):
     return time.strftime('%Y-%m-%d', time.gmtime(mark_time))
 
 
+@functools.lru_cache(maxsize=None)
+def code_version():
+    """Checksum of the app's files, so cached pages expire when the app is updated"""
+    root = os.path.dirname(os.path.abspath(__file__))
+    stamps = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+        for fname in sorted(filenames):
+            path = os.path.join(dirpath, fname)
+            stamps.append(f"{os.path.relpath(path, root)}:{os.stat(path).st_mtime_ns}")
+    return format(zlib.crc32('\n'.join(stamps).encode()), '08x')
+
+
+def db_version():
+    """(change_id, time of the last write) of the user's DB, read once per request"""
+    if 'db_version' not in g:
+        g.db_version = g.db.version()
+    return g.db_version
+
+
+def render_version(similarity=False):
+    """Version of cached renderings, they expire when the DB or the app change
+
+    With `similarity`, also when the similarity cache is refreshed, which
+    happens some time after the writes and doesn't change the DB version.
+    """
+    version = f"{db_version()[0]}-{code_version()}"
+    if similarity:
+        version += '-' + '.'.join(map(str, g.db.similarity_version()))
+    return version
+
+
+def cached_page(view=None, *, similarity=False):
+    """Serve the page from the render cache if it was rendered for the current DB version
+
+    Use `@cached_page(similarity=True)` for pages showing similar marks, they
+    are cached apart from the other pages, as they are versioned differently.
+    """
+    if view is None:
+        return functools.partial(cached_page, similarity=similarity)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = current_app.extensions['render_cache']
+        namespace = (g.user.name, 'similar') if similarity else g.user.name
+        name = 'page:' + request.full_path
+        version = render_version(similarity)
+        html = cache.get(namespace, version, name)
+        if html is not None:
+            return html
+        response = current_app.make_response(view(*args, **kwargs))
+        if response.status_code == 200 and not response.is_streamed:
+            cache.set(namespace, version, name, response.get_data(as_text=True))
+        return response
+    return wrapper
+
+
+def cached_fragment(*key, caller):
+    """Template helper, `{% call cached_fragment('mark', mark.id) %}` caches the enclosed HTML"""
+    cache = current_app.extensions['render_cache']
+    name = ':'.join(str(k) for k in key)
+    return Markup(cache.get_or_render(g.user.name, render_version(), name, lambda: str(caller())))
+
+
+def conditional(view=None, *, similarity=False):
+    """Answer with 304 Not Modified if the client already has the page for this DB version
+
+    Pages only change on DB writes, so the ETag and Last-Modified date are
+    derived from the DB's change counter, checked before the view runs.
+    Pages showing similar marks, `@conditional(similarity=True)`, also
+    change when the similarity cache is refreshed; they get no Last-Modified
+    date, which couldn't tell.
+    """
+    if view is None:
+        return functools.partial(conditional, similarity=similarity)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        modified = db_version()[1]
+        etag = f"{g.user.name}-{render_version(similarity)}"
+        last_modified = None
+        if modified and not similarity:
+            last_modified = datetime.fromtimestamp(int(modified), timezone.utc)
+        if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = current_app.make_response(view(*args, **kwargs))
+        else:
+            response = current_app.response_class(status=304)
+        # Weak, as responses may be gzipped or not.
+        response.set_etag(etag, weak=True)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+
 #################
 # Blueprint setup
 #################
@@ -42,19 +147,55 @@ def initialize_context():
         abort(404, f"No such user")
 
     g.user = types.SimpleNamespace(**user)
-    abs_url_prefix = current_app.config['ABS_ROOT_URL'].rstrip('/') + '/' + user['name']
-    g.db = tagbase.BookmarkDB(os.path.join(current_app.config['BASE_DIR'], user['database']),
-                              abs_url_prefix,
-                              stopwords=user.get('stopwords', []),
-                              stopword_languages=user.get('stopword_languages', []),
-                              ignore_hosts_in_search=user.get('ignore_hosts_in_search', []))
+    g.db = current_app.extensions['db_pool'].acquire(user['name'])
 
     current_app.jinja_env.globals['url_for_current_user'] = url_for_current_user
     current_app.jinja_env.globals['WHITESTAR'] = WHITESTAR
     current_app.jinja_env.globals['BLACKSTAR'] = BLACKSTAR
+    current_app.jinja_env.globals['cached_fragment'] = cached_fragment
     current_app.jinja_env.filters['format_date'] = format_date
 
 
+@bp.teardown_request
+def release_db(exc):
+    if 'db' in g:
+        current_app.extensions['db_pool'].release(g.user.name)
+
+
+def open_database(user_name):
+    """Open the BookmarkDB of a user, used by the app's DBPool"""
+    user = current_app.config['USERS'][user_name]
+    abs_url_prefix = current_app.config['ABS_ROOT_URL'].rstrip('/') + '/' + user['name']
+    return tagbase.BookmarkDB(os.path.join(current_app.config['BASE_DIR'], user['database']),
+                              abs_url_prefix,
+                              stopwords=user.get('stopwords', []),
+                              stopword_languages=user.get('stopword_languages', []),
+                              ignore_hosts_in_search=user.get('ignore_hosts_in_search', []),
+                              refresh_debounce=current_app.config.get('SIMILARITY_REFRESH_DEBOUNCE', 2.0),
+                              refresh_max_staleness=current_app.config.get('SIMILARITY_REFRESH_MAX_STALENESS', 30.0),
+                              precompute_similar=current_app.config.get('PRECOMPUTE_SIMILAR', 10))
+
+
+def preload_databases(app):
+    """Warm up the DB of every user, e.g. before a pre-forking server forks its workers
+
+    Forked workers share the imported modules and the loaded indexes with
+    the parent. SQLite connections must not cross fork(), so they are all
+    closed again, each worker opens its own.
+    """
+    pool = app.extensions['db_pool']
+    with app.app_context():
+        try:
+            for user_name in app.config['USERS']:
+                db = pool.acquire(user_name)
+                try:
+                    db.warm_up()
+                finally:
+                    pool.release(user_name)
+        finally:
+            pool.close_all()
+
+
 #########################################
 # Views for displaying existing bookmarks
 #########################################
@@ -66,7 +207,11 @@ def index():
 
 @bp.route('/<user>', defaults={'tag_name': None})
 @bp.route('/<user>/tags/<tag_name>')
+@conditional
+@cached_page
 def list_view(user, tag_name):
+    before_id = request.args.get("before", type=int)
+    after_id = request.args.get("after", type=int)
     offset = request.args.get("offset", type=int, default=0)
     pagesize = request.args.get("pagesize", type=int, default=current_app.config['PAGE_SIZE'])
 
@@ -74,16 +219,29 @@ def list_view(user, tag_name):
         redirect(url_for_current_user('.list_view'), 303)
 
     title = tag_name if tag_name else None
-    marks = g.db.get_marks(tag=tag_name, offset=offset, limit=pagesize)
+
+    # Pages are addressed by the mark right before or after them, `offset` is
+    # still understood for old links. One extra mark is loaded to know if
+    # there is another page in that direction.
+    marks = None
+    if after_id is not None:
+        newer = g.db.get_marks(tag=tag_name, after_id=after_id, limit=pagesize + 1)
+        if len(newer) > pagesize:
+            marks, has_prev, has_next = newer[1:], True, True
+    if marks is None:
+        # Also used if less than a page of newer marks is left.
+        if before_id is not None:
+            offset = 0
+        marks = g.db.get_marks(tag=tag_name, before_id=before_id, offset=offset, limit=pagesize + 1)
+        has_prev = before_id is not None or offset > 0
+        has_next = len(marks) > pagesize
+        marks = marks[:pagesize]
 
     next_link = prev_link = None
-    if offset > 0:
-        prev_offset = max(offset - pagesize, 0)
-        prev_link = url_for_current_user('.list_view', offset=prev_offset, pagesize=pagesize, tag_name=tag_name)
-    if len(marks) == pagesize:
-        # If total_mark_count % pagesize == 0, we display an empty last page. We'll live with this.
-        next_offset = offset + pagesize
-        next_link = url_for_current_user('.list_view', offset=next_offset, pagesize=pagesize, tag_name=tag_name)
+    if has_prev and marks:
+        prev_link = url_for_current_user('.list_view', after=marks[0].id, pagesize=pagesize, tag_name=tag_name)
+    if has_next:
+        next_link = url_for_current_user('.list_view', before=marks[-1].id, pagesize=pagesize, tag_name=tag_name)
 
     return render_template(
         'html_mark.html',
@@ -95,15 +253,16 @@ def list_view(user, tag_name):
 
 
 @bp.route('/<user>/mark.<int:mark_id>')
+@conditional
+@cached_page
 def mark_view(user, mark_id):
     mark = g.db.lookup(mark_id)
     if mark is None:
         abort(404, f"Mark not found: {mark_id}")
 
-    succs = g.db.get_successors(mark_id, count=1)
-    preds = g.db.get_predecessors(mark_id, count=1)
-    succ_link = url_for_current_user(".mark_view", mark_id=succs[0].id) if succs else None
-    pred_link = url_for_current_user(".mark_view", mark_id=preds[0].id) if preds else None
+    pred_id, succ_id = g.db.get_neighbor_ids(mark_id)
+    succ_link = url_for_current_user(".mark_view", mark_id=succ_id) if succ_id is not None else None
+    pred_link = url_for_current_user(".mark_view", mark_id=pred_id) if pred_id is not None else None
 
     return render_template(
         'html_mark.html',
@@ -115,36 +274,66 @@ def mark_view(user, mark_id):
 
 
 @bp.route('/<user>/tags')
+@conditional
+@cached_page
 def taglist_view(user):
     tags = g.db.get_tags()
     return render_template('html_tags.html', page_title='Tags', current_tag='tags', tags=tags)
 
 
+@bp.route('/<user>/tags.json')
+def tags_json_view(user):
+    prefix = request.args.get('q', '')
+    num = request.args.get('num', type=int, default=10)
+    return jsonify([tag.name for tag in g.db.complete_tag(prefix, num=num)])
+
+
+@bp.route('/<user>/suggest_tags.json')
+def suggest_tags_json_view(user):
+    mark = tagbase.Bookmark(title=request.args.get('title', ''),
+                            url=request.args.get('url', ''),
+                            note=request.args.get('note', ''),
+                            tags=request.args.get('tags', ''))
+    num = request.args.get('num', type=int, default=10)
+    return jsonify(g.db.suggest_tags(mark, num=num))
+
+
 @bp.route('/<user>/search')
+@conditional
+@cached_page
 def search_view(user):
     query = request.args.get("q")
     if not query:
         redirect(url_for_current_user('.list_view'), 303)
 
-    marks = g.db.get_marks()
     try:
-        search = SearchStrParser(query)
+        search = parse_query(query)
     except SearchStrParser.ParsingError as e:
         abort(400, f"Could not parse search string: {query!r}: {e.explanation}")
 
-    def contains(needle, mark):
-        if needle.startswith('tag:'):
-            return needle[4:] in mark.tags
-        else:
-            return mark.contains(needle)
-    marks = [m
-             for m in marks
-             if search.evaluate(callback=lambda needle: contains(needle, m))]
+    offset = request.args.get("offset", type=int, default=0)
+    pagesize = request.args.get("pagesize", type=int, default=current_app.config['PAGE_SIZE'])
+    order = request.args.get("order", default="relevance")
+    if request.args.get("nopage"):
+        offset, pagesize = 0, -1
+
+    marks = g.db.get_marks(query=search, offset=offset, limit=pagesize, by_relevance=(order == "relevance"))
+
+    next_link = prev_link = None
+    if offset > 0:
+        prev_offset = max(offset - pagesize, 0)
+        prev_link = url_for_current_user('.search_view', q=query, order=order, offset=prev_offset, pagesize=pagesize)
+    if len(marks) == pagesize:
+        next_offset = offset + pagesize
+        next_link = url_for_current_user('.search_view', q=query, order=order, offset=next_offset, pagesize=pagesize)
+
     return render_template(
         'html_mark.html',
         page_title=f'Search `{query}`',
         title=f"[ Search `{query}` ]",
-        marks=marks)
+        marks=marks,
+        next_page_link=next_link,
+        prev_page_link=prev_link)
 
 
 #################
@@ -166,13 +355,14 @@ def new_edit_view(user, mark_id):
             raise abort(404, "Bookmark not found")
         page_title = f'Edit `{mark.title}`'
 
+    similar_marks, suggested_tags = g.db.find_similar_and_suggest_tags(mark)
     return render_template(
         "html_editform.html",
         mark=mark,
         page_title=page_title,
         same_url_marks=g.db.get_marks(url=mark.url, not_mark_id=mark.id),
-        similar_marks=g.db.find_similar(mark),
-        all_tags=[t.name for t in g.db.get_tags(sort_by_frequency=True)],
+        similar_marks=similar_marks,
+        suggested_tags=suggested_tags,
     )
 
 
@@ -213,6 +403,8 @@ def delete_view(user, mark_id):
 ###############
 
 @bp.route('/<user>/mark.<int:mark_id>/similar')
+@conditional(similarity=True)
+@cached_page(similarity=True)
 def similar_view(user, mark_id):
     mark = g.db.lookup(mark_id)
     if not mark:
@@ -222,7 +414,76 @@ def similar_view(user, mark_id):
     return render_template('similar.html', similar_marks=similar)
 
 
+@bp.route('/<user>/similar.json')
+def similar_json_view(user):
+    try:
+        mark_ids = [int(id) for id in request.args.get('ids', '').split(',') if id.strip()]
+        num = min(int(request.args.get('num', 10)), MAX_SIMILAR)
+    except ValueError:
+        abort(400, "ids must be a comma-separated list of mark IDs")
+
+    marks = g.db.get_marks(mark_ids=mark_ids)
+    similar_ids = g.db.find_similar_ids(marks, num=num)
+    return jsonify({str(m.id): ids for m, ids in zip(marks, similar_ids)})
+
+
+@bp.route('/<user>/render_cache_status')
+def render_cache_status_view(user):
+    return jsonify(current_app.extensions['render_cache'].stats())
+
+
+@bp.route('/<user>/similarity_status')
+def similarity_status_view(user):
+    return jsonify(g.db.similarity_refresh_status())
+
+
+def _buffered(chunks, size=64 * 1024):
+    """Join small string chunks into blocks of about `size` encoded bytes"""
+    buf = []
+    buf_len = 0
+    for chunk in chunks:
+        chunk = chunk.encode()
+        buf.append(chunk)
+        buf_len += len(chunk)
+        if buf_len >= size:
+            yield b''.join(buf)
+            buf = []
+            buf_len = 0
+    if buf:
+        yield b''.join(buf)
+
+
+def _gzipped(blocks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def streamed_response(chunks, mimetype):
+    """A response sending `chunks` as they are generated, gzipped if the client accepts it"""
+    blocks = _buffered(chunks)
+    headers = {'Vary': 'Accept-Encoding'}
+    if 'gzip' in request.accept_encodings:
+        blocks = _gzipped(blocks)
+        headers['Content-Encoding'] = 'gzip'
+    return current_app.response_class(stream_with_context(blocks), mimetype=mimetype, headers=headers)
+
+
 @bp.route('/<user>/export.xml')
+@conditional
 def export_view(user):
-    marks = g.db.get_marks()
-    return render_template('xml_export.xml', marks=marks)
+    chunks = stream_template('xml_export.xml', marks=g.db.iter_marks())
+    return streamed_response(chunks, 'application/xml')
+
+
+@bp.route('/<user>/export.jsonl')
+@conditional
+def export_jsonl_view(user):
+    def lines():
+        for mark in g.db.iter_marks():
+            yield json.dumps(dict(id=mark.id, url=mark.url, title=mark.title, tags=mark.tags.split(),
+                                  time=mark.time, note=mark.note), ensure_ascii=False) + '\n'
+    return streamed_response(lines(), 'application/jsonl')
@@ -0,0 +1,49 @@
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from . import bookmarks
+
+
+@click.command('reindex-crosslinks')
+@click.argument('users', nargs=-1)
+@with_appcontext
+def reindex_crosslinks_command(users):
+    """Rebuild the crosslinks between marks from their notes (default: for all users)"""
+    for user_name in users or current_app.config['USERS']:
+        db = bookmarks.open_database(user_name)
+        try:
+            num_links = db.reindex_crosslinks()
+        finally:
+            db.close()
+        click.echo(f"{user_name}: {num_links} crosslinks")
+
+
+@click.command('import-xml')
+@click.argument('user')
+@click.argument('xml_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=1000, show_default=True, help="Marks inserted per batch.")
+@with_appcontext
+def import_xml_command(user, xml_file, batch_size):
+    """Add the bookmarks of an export.xml file to USER's database"""
+    start = time.monotonic()
+
+    def progress(num_imported):
+        elapsed = time.monotonic() - start
+        click.echo(f"{num_imported} marks imported, {num_imported / max(elapsed, 1e-6):.0f} marks/s")
+
+    db = bookmarks.open_database(user)
+    try:
+        num_imported = db.import_xml(xml_file, batch_size=batch_size, progress=progress)
+        click.echo("Updating the similarity cache...")
+        db.update_similarity_cache()
+    finally:
+        db.close()
+    click.echo(f"Imported {num_imported} marks in {time.monotonic() - start:.1f}s")
+
+
+def init_app(app):
+    app.cli.add_command(reindex_crosslinks_command)
+    app.cli.add_command(import_xml_command)
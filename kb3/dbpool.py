@@ -0,0 +1,130 @@
+import collections
+import os
+import threading
+import time
+
+
+class _PoolEntry:
+    def __init__(self, db, generation):
+        self.db = db
+        self.generation = generation
+        self.file_id = self._stat(db.dbfname)
+        self.in_use = False
+        self.last_used = time.monotonic()
+
+    @staticmethod
+    def _stat(fname):
+        try:
+            st = os.stat(fname)
+        except FileNotFoundError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    def is_current(self, generation):
+        """Check that the DB file was neither replaced nor explicitly reopened"""
+        return (self.generation == generation and
+                self.file_id is not None and
+                self.file_id == self._stat(self.db.dbfname))
+
+    def close(self):
+        self.db.close()
+
+
+class DBPool:
+    """Registry of open BookmarkDB handles, reused across requests
+
+    Handles are kept per user and per worker thread, so a thread never sees
+    a connection that another thread is using. `factory(user_name)` is called
+    to open a new handle when none is available.
+
+    At most `max_size` handles are kept open; when more are needed, the least
+    recently used idle ones are closed. Handles idle for longer than
+    `idle_timeout` seconds are closed as well.
+    """
+
+    def __init__(self, factory, *, max_size=32, idle_timeout=300):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()   # (user, thread) -> _PoolEntry, LRU first
+        self.generations = collections.Counter()   # user -> bumped by reopen()
+        self.pid = os.getpid()
+        self.inherited = []                        # Handles of the parent process, never closed
+
+    def acquire(self, user_name):
+        key = (user_name, threading.get_ident())
+        with self.lock:
+            self._forget_if_forked()
+            entry = self.entries.pop(key, None)
+            generation = self.generations[user_name]
+
+        if entry is not None and not entry.is_current(generation):
+            entry.close()
+            entry = None
+        if entry is None:
+            entry = _PoolEntry(self.factory(user_name), generation)
+        entry.in_use = True
+
+        with self.lock:
+            self.entries[key] = entry
+            expired = self._pop_expired()
+        for e in expired:
+            e.close()
+        return entry.db
+
+    def release(self, user_name):
+        key = (user_name, threading.get_ident())
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return
+        if entry.db.dbconn.in_transaction:
+            # Don't leak a half-done write of a failed request into the next one.
+            entry.db.dbconn.rollback()
+        entry.in_use = False
+        entry.last_used = time.monotonic()
+
+    def reopen(self, user_name=None):
+        """Drop handles, e.g. after the DB file was replaced or restored
+
+        Idle handles are closed immediately, handles in use are closed as soon
+        as the thread using them asks for a new one.
+        If `user_name` is None, handles of all users are dropped.
+        """
+        with self.lock:
+            users = {u for u, _ in self.entries} if user_name is None else {user_name}
+            for u in users:
+                self.generations[u] += 1
+            stale = [(k, e) for k, e in self.entries.items() if k[0] in users and not e.in_use]
+            for k, _ in stale:
+                del self.entries[k]
+        for _, e in stale:
+            e.close()
+
+    def close_all(self):
+        with self.lock:
+            entries = list(self.entries.values())
+            self.entries.clear()
+        for e in entries:
+            e.close()
+
+    def _pop_expired(self):
+        now = time.monotonic()
+        idle = [(k, e) for k, e in self.entries.items() if not e.in_use]
+        num_excess = len(self.entries) - self.max_size
+        expired = []
+        for k, e in idle:
+            if num_excess > 0 or now - e.last_used > self.idle_timeout:
+                del self.entries[k]
+                expired.append(e)
+                num_excess -= 1
+        return expired
+
+    def _forget_if_forked(self):
+        # SQLite connections must not be used across fork(): drop, don't close them.
+        # Closing happens when the last reference goes, so they are kept referenced.
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.inherited.extend(self.entries.values())
+            self.entries.clear()
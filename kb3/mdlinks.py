@@ -0,0 +1,379 @@
+import html
+import re
+
+_ASCII_PUNCTUATION = r"""!"#$%&'()*+,-./:;<=>?@[\]^_`{|}~"""
+
+_ATTRIBUTE = r'''\s+[A-Za-z_:][A-Za-z0-9_.:-]*(?:\s*=\s*(?:[^\s"'=<>`]+|'[^']*'|"[^"]*"))?'''
+_OPEN_TAG = rf'<[A-Za-z][A-Za-z0-9-]*(?:{_ATTRIBUTE})*\s*/?>'
+_CLOSE_TAG = r'</[A-Za-z][A-Za-z0-9-]*\s*>'
+_RAW_HTML = re.compile(rf'{_OPEN_TAG}|{_CLOSE_TAG}|<!--.*?-->|<\?.*?\?>|<![A-Za-z][^>]*>|<!\[CDATA\[.*?\]\]>', re.S)
+_HTML_COMMENT = re.compile(r'<!--.*?-->', re.S)
+_ANCHOR_TAG = re.compile(rf'<a(?=[\s/>])((?:{_ATTRIBUTE})*)\s*/?>', re.I)
+_ANCHOR_CLOSE = re.compile(r'</a\s*>', re.I)
+_HREF_ATTRIBUTE = re.compile(r'''\shref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+))''', re.I)
+
+_AUTOLINK = re.compile(r'<([A-Za-z][A-Za-z0-9+.-]{1,31}:[^\x00-\x20<>]*)>')
+_EMAIL_AUTOLINK = re.compile(r"<([A-Za-z0-9.!#$%&'*+/=?^_`{|}~-]+@[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?"
+                             r"(?:\.[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?)*)>")
+_BACKTICKS = re.compile(r'`+')
+_LINK_LABEL = re.compile(r'\[((?:[^\\\[\]]|\\.){0,999})\]', re.S)
+_LINK_TITLE = r'''(?:"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|\((?:[^()\\]|\\.)*\))'''
+_ANGLE_DESTINATION = re.compile(r'<((?:[^<>\n\\]|\\.)*)>')
+_INLINE_LINK_END = re.compile(rf'(?:\s*(?<=\s){_LINK_TITLE})?\s*\)', re.S)
+_LINK_DEFINITION = re.compile(rf'''[ ]{{0,3}}\[((?:[^\\\[\]]|\\.){{1,999}})\]:[ \t]*\n?[ \t]*
+                                   (<(?:[^<>\n\\]|\\.)*>|\S+)
+                                   (?:[ \t]*\n?[ \t]*(?<=\s){_LINK_TITLE})?
+                                   [ \t]*(?:\n|$)''', re.S | re.X)
+_WHITESPACE = re.compile(r'[ \t]*\n?[ \t]*')
+_ESCAPED = re.compile(r'\\([' + re.escape(_ASCII_PUNCTUATION) + '])')
+
+_BLOCKQUOTE = re.compile(r' {0,3}> ?')
+_LIST_ITEM = re.compile(r' {0,3}(?:[-+*]|(\d{1,9})[.)])(?= |$)')
+_THEMATIC_BREAK = re.compile(r' {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$')
+_SETEXT_UNDERLINE = re.compile(r' {0,3}(?:=+|-+)[ \t]*$')
+_ATX_HEADING = re.compile(r' {0,3}#{1,6}(?:[ \t]|$)')
+_FENCE = re.compile(r' {0,3}(`{3,}(?=[^`]*$)|~{3,})')
+_HTML_BLOCKS = [
+    # (start, end or None for "at a blank line", may contain anchors, may interrupt a paragraph)
+    (re.compile(r' {0,3}<pre(?:\s|>|$)', re.I), re.compile(r'</pre>', re.I), True, True),
+    (re.compile(r' {0,3}<(?:script|style|textarea)(?:\s|>|$)', re.I),
+     re.compile(r'</(?:script|style|textarea)>', re.I), False, True),
+    (re.compile(r' {0,3}<!--'), re.compile(r'-->'), False, True),
+    (re.compile(r' {0,3}<\?'), re.compile(r'\?>'), False, True),
+    (re.compile(r' {0,3}<!\[CDATA\['), re.compile(r'\]\]>'), False, True),
+    (re.compile(r' {0,3}<![A-Za-z]'), re.compile(r'>'), False, True),
+    (re.compile(r' {0,3}</?(?:address|article|aside|base|basefont|blockquote|body|caption|center|col|colgroup|dd|'
+                r'details|dialog|dir|div|dl|dt|fieldset|figcaption|figure|footer|form|frame|frameset|h[1-6]|'
+                r'head|header|hr|html|iframe|legend|li|link|main|menu|menuitem|nav|noframes|ol|optgroup|'
+                r'option|p|param|search|section|summary|table|tbody|td|tfoot|th|thead|title|tr|track|ul)'
+                r'(?:\s|/?>|$)', re.I), None, True, True),
+    (re.compile(rf' {{0,3}}(?:{_OPEN_TAG}|{_CLOSE_TAG})[ \t]*$'), None, True, False),
+]
+
+
+def extract_links(markdown):
+    """Yield (text, href) of every link in CommonMark text, in document order
+
+    Finds what a CommonMark renderer like pandoc turns into <a href> elements:
+    inline links, reference links, autolinks, and anchors in raw HTML. Links
+    in code spans, code blocks, HTML comments and image descriptions don't
+    count. Markup within the link text is returned as written.
+    """
+    blocks = _Blocks(markdown or '')
+    references = {}
+    # Definitions may follow the links using them, so collect them first.
+    inline = [(line_no, _split_definitions(text, references)) for line_no, text in blocks.inline]
+    links = []
+    for line_no, text in inline:
+        links.extend(((line_no, pos), text, href) for pos, text, href in _inline_links(text, references))
+    for line_no, text in blocks.html:
+        text = _HTML_COMMENT.sub('', text)
+        for m in _ANCHOR_TAG.finditer(text):
+            link = _anchor_link(text, m)
+            if link is not None:
+                links.append(((line_no, m.start()), *link))
+    # Blocks were collected by kind, bring the links back into document order.
+    for _, text, href in sorted(links, key=lambda link: link[0]):
+        yield text, href
+
+
+def _unescape(s):
+    return html.unescape(_ESCAPED.sub(r'\1', s))
+
+
+def _normalize_label(label):
+    return ' '.join(label.split()).casefold()
+
+
+def _is_valid_label(label):
+    return bool(label.strip()) and len(label) <= 999 and not re.search(r'(?<!\\)[\[\]]', label)
+
+
+def _split_definitions(text, references):
+    """Strip link reference definitions from the start of a paragraph into `references`"""
+    pos = 0
+    while True:
+        m = _LINK_DEFINITION.match(text, pos)
+        if not m or not _is_valid_label(m.group(1)):
+            return text[pos:]
+        destination = m.group(2)
+        if destination.startswith('<'):
+            destination = destination[1:-1]
+        references.setdefault(_normalize_label(m.group(1)), _unescape(destination))
+        pos = m.end()
+
+
+def _anchor_link(s, m):
+    """(text, href) of the <a> tag matched by `m` in `s`, None if it has no href"""
+    href = _HREF_ATTRIBUTE.search(m.group(1))
+    if href is None:
+        return None
+    close = _ANCHOR_CLOSE.search(s, m.end())
+    text = s[m.end():close.start()] if close else s[m.end():]
+    return text, html.unescape(next(g for g in href.groups() if g is not None))
+
+
+def _inline_links(s, references):
+    """Return (position, text, href) of the links in the inline content `s` of a block"""
+    links = []
+    openers = []        # [position of '[', is image, active], innermost last
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c == '\\' and i + 1 < len(s) and s[i + 1] in _ASCII_PUNCTUATION:
+            i += 2
+        elif c == '`':
+            run = _BACKTICKS.match(s, i).group()
+            close = re.compile(rf'(?<!`){run}(?!`)').search(s, i + len(run))
+            i = close.end() if close else i + len(run)
+        elif c == '<':
+            m = _AUTOLINK.match(s, i) or _EMAIL_AUTOLINK.match(s, i)
+            if m:
+                href = m.group(1) if m.re is _AUTOLINK else 'mailto:' + m.group(1)
+                links.append((i, m.group(1), href))
+                i = m.end()
+                continue
+            m = _RAW_HTML.match(s, i)
+            if m:
+                anchor = _ANCHOR_TAG.match(s, i)
+                link = _anchor_link(s, anchor) if anchor and anchor.end() == m.end() else None
+                if link is not None:
+                    links.append((i, *link))
+                i = m.end()
+            else:
+                i += 1
+        elif c == '!' and s.startswith('[', i + 1):
+            openers.append([i + 1, True, True])
+            i += 2
+        elif c == '[':
+            openers.append([i, False, True])
+            i += 1
+        elif c == ']' and openers:
+            start, is_image, active = openers.pop()
+            text = s[start + 1:i]
+            link = _link_tail(s, i + 1, text, references) if active else None
+            if link is None:
+                i += 1
+                continue
+            href, i = link
+            if is_image:
+                # Links in an image description are rendered as plain alt text.
+                links = [link for link in links if link[0] < start]
+            else:
+                links.append((start, text, href))
+                # Links may not contain other links.
+                for opener in openers:
+                    if not opener[1]:
+                        opener[2] = False
+        else:
+            i += 1
+    return links
+
+
+def _link_tail(s, pos, text, references):
+    """Parse what follows the link text `[text]` at `pos`, return (href, end) or None"""
+    if s.startswith('(', pos):
+        link = _inline_destination(s, pos + 1)
+        if link is not None:
+            return link
+
+    m = _LINK_LABEL.match(s, pos)
+    if m and m.group(1):
+        # Full reference link, `[text][label]`.
+        if not _is_valid_label(m.group(1)):
+            return None
+        href = references.get(_normalize_label(m.group(1)))
+        return (href, m.end()) if href is not None else None
+
+    # Collapsed `[label][]` or shortcut `[label]` reference link.
+    if not _is_valid_label(text):
+        return None
+    href = references.get(_normalize_label(text))
+    return (href, m.end() if m else pos) if href is not None else None
+
+
+def _inline_destination(s, pos):
+    """Parse the `destination "title")` part of an inline link, return (href, end) or None"""
+    pos = _WHITESPACE.match(s, pos).end()
+    m = _ANGLE_DESTINATION.match(s, pos)
+    if m:
+        destination, pos = m.group(1), m.end()
+    elif s.startswith('<', pos):
+        return None
+    else:
+        start, depth = pos, 0
+        while pos < len(s):
+            c = s[pos]
+            if c == '\\' and pos + 1 < len(s) and s[pos + 1] in _ASCII_PUNCTUATION:
+                pos += 2
+                continue
+            if c <= ' ':
+                break
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                if not depth:
+                    break
+                depth -= 1
+            pos += 1
+        if depth:
+            return None
+        destination = s[start:pos]
+
+    m = _INLINE_LINK_END.match(s, pos)
+    if not m:
+        return None
+    return _unescape(destination), m.end()
+
+
+class _Blocks:
+    """Split CommonMark text into the inline content of its paragraphs and headings, and its raw HTML
+
+    Follows CommonMark's block structure far enough to tell which text is
+    parsed for inline links: block quotes and list items are tracked by
+    their indentation, code blocks are dropped. Each entry of `inline` and
+    `html` is a (line number, text) tuple.
+    """
+
+    def __init__(self, text):
+        self.inline = []
+        self.html = []
+        self.containers = []       # '>' for block quotes, [content indentation, still empty] for list items
+        self.paragraph = None      # Lines of the open paragraph
+        self.fence = None          # Opening fence of the open fenced code block
+        self.html_block = None     # (end regex, lines, may contain anchors) of the open HTML block
+        self.leaf_start = None     # Line number of the open paragraph or HTML block
+        self.line_no = 0
+        for self.line_no, line in enumerate(text.expandtabs(4).splitlines()):
+            self.add_line(line)
+        self.close_leaf()
+
+    def add_line(self, line):
+        rest, num_matched = self.match_containers(line)
+        if num_matched < len(self.containers):
+            if self.paragraph is not None and rest.strip() and not self.starts_block(rest):
+                # Lazy continuation line of a paragraph.
+                self.paragraph.append(rest.lstrip())
+                return
+            self.close_leaf()
+            del self.containers[num_matched:]
+
+        if self.fence is not None:
+            if re.match(rf' {{0,3}}{re.escape(self.fence)}{re.escape(self.fence[0])}*[ \t]*$', rest):
+                self.fence = None
+            return
+        if self.html_block is not None:
+            end, lines, _ = self.html_block
+            if end is None and not rest.strip():
+                self.close_leaf()
+                return
+            lines.append(rest)
+            if end is not None and end.search(rest):
+                self.close_leaf()
+            return
+
+        self.add_leaf(self.open_containers(rest))
+
+    def match_containers(self, line):
+        rest = line
+        for i, container in enumerate(self.containers):
+            if container == '>':
+                m = _BLOCKQUOTE.match(rest)
+                if not m:
+                    return rest, i
+                rest = rest[m.end():]
+            elif not rest.strip():
+                # A list item may start with at most one blank line.
+                if container[1]:
+                    return rest, i
+                rest = ''
+            elif self.indentation(rest) >= container[0]:
+                container[1] = False
+                rest = rest[container[0]:]
+            else:
+                return rest, i
+        return rest, len(self.containers)
+
+    def open_containers(self, rest):
+        while self.indentation(rest) < 4:
+            m = _BLOCKQUOTE.match(rest)
+            if m:
+                self.close_leaf()
+                self.containers.append('>')
+                rest = rest[m.end():]
+                continue
+            m = _LIST_ITEM.match(rest)
+            if not m or _THEMATIC_BREAK.match(rest):
+                break
+            content = rest[m.end():]
+            if self.paragraph is not None and (not content.strip() or m.group(1) not in (None, '1')):
+                break
+            self.close_leaf()
+            spaces = self.indentation(content)
+            if not content.strip() or spaces > 4:
+                spaces = 1
+            self.containers.append([m.end() + spaces, not content.strip()])
+            rest = content[spaces:]
+        return rest
+
+    def add_leaf(self, rest):
+        if not rest.strip():
+            self.close_leaf()
+            return
+        if self.indentation(rest) >= 4:
+            if self.paragraph is not None:
+                self.paragraph.append(rest.lstrip())
+            # Otherwise, an indented code block.
+            return
+
+        if self.paragraph is not None and _SETEXT_UNDERLINE.match(rest):
+            # The paragraph was a heading.
+            self.close_leaf()
+            return
+        m = _FENCE.match(rest)
+        if m:
+            self.close_leaf()
+            self.fence = m.group(1)
+            return
+        for start, end, has_anchors, interrupts_paragraph in _HTML_BLOCKS:
+            if start.match(rest) and (interrupts_paragraph or self.paragraph is None):
+                self.close_leaf()
+                self.leaf_start = self.line_no
+                self.html_block = (end, [rest], has_anchors)
+                if end is not None and end.search(rest, start.match(rest).end()):
+                    self.close_leaf()
+                return
+        if _THEMATIC_BREAK.match(rest):
+            self.close_leaf()
+            return
+        if _ATX_HEADING.match(rest):
+            self.close_leaf()
+            self.inline.append((self.line_no, rest))
+            return
+
+        if self.paragraph is None:
+            self.leaf_start = self.line_no
+            self.paragraph = []
+        self.paragraph.append(rest.lstrip())
+
+    def starts_block(self, rest):
+        if self.indentation(rest) >= 4:
+            return False
+        return bool(_BLOCKQUOTE.match(rest) or _LIST_ITEM.match(rest) or _FENCE.match(rest) or
+                    _ATX_HEADING.match(rest) or _THEMATIC_BREAK.match(rest) or
+                    any(start.match(rest) for start, _, _, interrupts in _HTML_BLOCKS if interrupts))
+
+    def close_leaf(self):
+        if self.paragraph is not None:
+            self.inline.append((self.leaf_start, '\n'.join(self.paragraph)))
+            self.paragraph = None
+        if self.html_block is not None:
+            _, lines, has_anchors = self.html_block
+            if has_anchors:
+                self.html.append((self.leaf_start, '\n'.join(lines)))
+            self.html_block = None
+        self.fence = None
+
+    @staticmethod
+    def indentation(s):
+        return len(s) - len(s.lstrip(' '))
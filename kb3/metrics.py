@@ -0,0 +1,264 @@
+"""Always-on timing of requests and of the phases they spend their time in
+
+Code that may be slow is wrapped in `timer(phase)` or decorated with
+`timed(phase)`; SQL statements are timed by the TimedConnection that
+BookmarkDB connects with. Outside of a request, timers do nothing.
+
+At the end of each request, its total time and the time it spent in each
+phase are added to per-route histograms, served in the Prometheus text
+format at /metrics. Phases may overlap: find_similar includes the SQL it
+runs, and streamed templates include the SQL of the rows they fetch. With
+the SERVER_TIMING config setting, the phases are also sent in a
+Server-Timing response header.
+
+Histograms are kept per process, scrape each worker process separately.
+"""
+
+import bisect
+import contextlib
+import contextvars
+import functools
+import sqlite3
+import threading
+import time
+
+from flask import g, request, template_rendered, before_render_template
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current = contextvars.ContextVar('kb3_request_timings', default=None)
+
+
+class RequestTimings:
+    """Seconds spent and number of calls in each phase of the current request"""
+    __slots__ = ('start', 'seconds', 'calls', 'render_starts')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.seconds = {}
+        self.calls = {}
+        self.render_starts = []
+
+    def add(self, phase, seconds, calls=1):
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + calls
+
+
+@contextlib.contextmanager
+def timer(phase):
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(phase, time.perf_counter() - t)
+
+
+def timed(phase):
+    """Decorator, time each call of the function as `phase`"""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with timer(phase):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor timing its statements and fetches as the `sql` phase"""
+
+    def _timed(self, method, *args, calls=1):
+        timings = _current.get()
+        if timings is None:
+            return method(*args)
+        t = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            timings.add('sql', time.perf_counter() - t, calls)
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def executescript(self, script):
+        return self._timed(super().executescript, script)
+
+    # Most rows are stepped through while fetching, not in execute().
+    def fetchone(self):
+        return self._timed(super().fetchone, calls=0)
+
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, self.arraysize if size is None else size, calls=0)
+
+    def fetchall(self):
+        return self._timed(super().fetchall, calls=0)
+
+    def __next__(self):
+        return self._timed(super().__next__, calls=0)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose statements are timed, use as `sqlite3.connect(..., factory=TimedConnection)`
+
+    sqlite3's trace callback only reports when a statement starts, so the
+    cursors are timed instead. The shortcut methods of Connection don't go
+    through Cursor's Python methods, they are routed through cursor() here.
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+    def commit(self):
+        with timer('sql'):
+            super().commit()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)      # Not cumulative, the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+
+class Registry:
+    """Histograms and counters by metric name and label values"""
+
+    HELP = {
+        'kb3_request_duration_seconds': "Time to handle a request, by route and status",
+        'kb3_phase_duration_seconds': "Time a request spent in a phase, by route and phase",
+        'kb3_phase_calls_total': "Statements or calls of each phase, by route and phase",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}    # (name, labels) -> Histogram, labels as tuple of (key, value)
+        self.counters = {}      # (name, labels) -> value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self.lock:
+            histograms = sorted((key, list(h.counts), h.sum) for key, h in self.histograms.items())
+            counters = sorted(self.counters.items())
+
+        lines = []
+        last_name = None
+        for (name, labels), counts, total in histograms:
+            if name != last_name:
+                lines += [f"# HELP {name} {self.HELP[name]}", f"# TYPE {name} histogram"]
+                last_name = name
+            cumulative = 0
+            for le, count in zip([*map(str, BUCKETS), '+Inf'], counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        for (name, labels), value in counters:
+            if name != last_name:
+                lines += [f"# HELP {name} {self.HELP[name]}", f"# TYPE {name} counter"]
+                last_name = name
+            lines.append(f"{name}{_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+
+registry = Registry()
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+
+
+def _server_timing(response):
+    timings = _current.get()
+    if timings is None:
+        return response
+    g.response_status = response.status_code
+    if g.get('server_timing'):
+        entries = [f'{phase};dur={seconds * 1000:.2f}' for phase, seconds in timings.seconds.items()]
+        entries.append(f'total;dur={(time.perf_counter() - timings.start) * 1000:.2f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+
+def _finish_request(exc):
+    timings = _current.get()
+    if timings is None:
+        return
+    _current.set(None)
+    route = _route()
+    status = g.get('response_status', 500)
+    registry.observe('kb3_request_duration_seconds', dict(route=route, status=status),
+                     time.perf_counter() - timings.start)
+    for phase, seconds in timings.seconds.items():
+        labels = dict(route=route, phase=phase)
+        registry.observe('kb3_phase_duration_seconds', labels, seconds)
+        registry.inc('kb3_phase_calls_total', labels, timings.calls[phase])
+
+
+def _render_started(sender, template, context, **extra):
+    timings = _current.get()
+    if timings is not None:
+        timings.render_starts.append(time.perf_counter())
+
+
+def _render_finished(sender, template, context, **extra):
+    timings = _current.get()
+    if timings is not None and timings.render_starts:
+        timings.add('render', time.perf_counter() - timings.render_starts.pop())
+
+
+def metrics_view():
+    return registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+def init_app(app):
+    server_timing = app.config.get('SERVER_TIMING', False)
+
+    def start_request():
+        _current.set(RequestTimings())
+        g.server_timing = server_timing
+
+    app.before_request(start_request)
+    app.after_request(_server_timing)
+    app.teardown_request(_finish_request)
+    before_render_template.connect(_render_started, app)
+    template_rendered.connect(_render_finished, app)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
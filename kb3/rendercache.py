@@ -0,0 +1,128 @@
+import collections
+import hashlib
+import os
+import shutil
+import threading
+
+
+class RenderCache:
+    """LRU cache of rendered HTML, optionally backed by a directory shared across processes
+
+    Entries are grouped by a namespace (e.g. the user) and a version (e.g. the
+    DB's change_id). Looking up an entry for a newer version never finds one
+    rendered for an older version, those are evicted from memory as they age
+    out and removed from disk when the namespace's version moves on. Entries
+    versioned differently need a namespace of their own, which may be a tuple
+    like (user, 'similar').
+
+    At most `max_bytes` of rendered text are kept in memory. With `directory`,
+    entries are also written there, so other worker processes can reuse them.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()   # (namespace, version, name) -> text, LRU first
+        self.size = 0
+        self.disk_versions = {}                    # namespace -> version last written to disk
+        self.hits = self.disk_hits = self.misses = 0
+
+    def get(self, namespace, version, name):
+        key = (namespace, version, name)
+        with self.lock:
+            text = self.entries.get(key)
+            if text is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return text
+        text = self._read_disk(key)
+        with self.lock:
+            if text is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, text)
+        return text
+
+    def set(self, namespace, version, name, text):
+        key = (namespace, version, name)
+        with self.lock:
+            self._remember(key, text)
+        self._write_disk(key, text)
+
+    def get_or_render(self, namespace, version, name, render):
+        text = self.get(namespace, version, name)
+        if text is None:
+            text = render()
+            self.set(namespace, version, name, text)
+        return text
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, disk_hits=self.disk_hits, misses=self.misses,
+                        entries=len(self.entries), bytes=self.size, max_bytes=self.max_bytes)
+
+    def _remember(self, key, text):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        if len(text) > self.max_bytes:
+            return
+        self.entries[key] = text
+        self.size += len(text)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def _path(self, key):
+        namespace, version, name = key
+        digest = hashlib.sha1(name.encode()).hexdigest()
+        # _safe_name() never yields a '.', tuples can't clash with plain names.
+        if isinstance(namespace, tuple):
+            namespace_dir = '.'.join(_safe_name(part) for part in namespace)
+        else:
+            namespace_dir = _safe_name(namespace)
+        return os.path.join(self.directory, namespace_dir, _safe_name(version), digest)
+
+    def _read_disk(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, key, text):
+        if self.directory is None:
+            return
+        namespace, version, _ = key
+        path = self._path(key)
+        if self.disk_versions.get(namespace) != version:
+            self.disk_versions[namespace] = version
+            self._remove_old_versions(os.path.dirname(os.path.dirname(path)), _safe_name(version))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_fname = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+            with open(tmp_fname, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_fname, path)
+        except OSError:
+            # The disk tier is an optimization only.
+            pass
+
+    @staticmethod
+    def _remove_old_versions(namespace_dir, current):
+        try:
+            entries = list(os.scandir(namespace_dir))
+        except OSError:
+            return
+        for entry in entries:
+            if entry.name != current:
+                # Other processes may be removing it at the same time.
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def _safe_name(s):
+    return ''.join(c if c.isalnum() or c in '-_' else '_' for c in str(s))
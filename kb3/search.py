@@ -1,3 +1,4 @@
+import functools
 import re
 
 class SearchStrParser:
@@ -165,6 +166,40 @@ class SearchStrParser:
         if stack_size != 1:
             raise SearchStrParser.ParsingError("Unknown syntax error")
 
+    def fold(self, needle, not_, and_, or_):
+        """Translate the query bottom-up into an arbitrary representation
+
+        `needle(str)` is called for every search term, `not_(x)`,
+        `and_(lhs, rhs)` and `or_(lhs, rhs)` combine the translated
+        sub-expressions.
+        """
+        combine = {SearchStrParser.Not: not_, SearchStrParser.And: and_, SearchStrParser.Or: or_}
+        stack = []
+        for token in self.rpn:
+            if isinstance(token, SearchStrParser.Operator):
+                args = stack[-token.valence:]
+                del stack[-token.valence:]
+                stack.append(combine[type(token)](*args))
+            else:
+                stack.append(needle(token))
+        if len(stack) != 1:
+            raise RuntimeError("Stack gone wrong: " + repr(stack))
+        return stack[0]
+
+    def compile(self, needle):
+        """Translate the query into a single predicate `f(x)`
+
+        `needle(str)` returns the predicate for a search term. `And` and `Or`
+        short-circuit, so terms that can't change the result aren't checked.
+        """
+        def not_(p):
+            return lambda x: not p(x)
+        def and_(lhs, rhs):
+            return lambda x: lhs(x) and rhs(x)
+        def or_(lhs, rhs):
+            return lambda x: lhs(x) or rhs(x)
+        return self.fold(needle, not_=not_, and_=and_, or_=or_)
+
     def evaluate(self, callback):
         stack = []
         for token in self.rpn:
@@ -179,3 +214,12 @@ class SearchStrParser:
         if len(stack) != 1:
             raise RuntimeError("Stack gone wrong: " + repr(stack))
         return stack[0]
+
+
+@functools.lru_cache(maxsize=256)
+def parse_query(query):
+    """Parse `query`, reusing the result for recently parsed queries
+
+    The returned parser must not be modified. ParsingErrors aren't cached.
+    """
+    return SearchStrParser(query)
@@ -512,9 +512,9 @@ $(document).ready(function() {
     });
 
     class TagAutoComplete {
-        constructor(selector, allTags, options) {
+        constructor(selector, completeUrl, options) {
             this.selector = selector;
-            this.allTags = allTags;
+            this.completeUrl = completeUrl;
             $(selector)
                 .on("keydown", (event) => {
                     // Don't navigate away from the field on tab when selecting an item.
@@ -562,7 +562,9 @@ $(document).ready(function() {
         }
         source = (request, response) => {
             console.assert(request.term === this.el.value);
-            response($.ui.autocomplete.filter(this.allTags, this.getCompletableWord().value));
+            $.getJSON(this.completeUrl, {q: this.getCompletableWord().value, num: 20})
+                .done(response)
+                .fail(() => response([]));
         }
         select = (event, ui) => {
             const tags = this.splitTags(this.el.value);
@@ -580,7 +582,16 @@ $(document).ready(function() {
         }
     }
     if ($("#tags-input").length) {
-        const allTags = $("#tags-input").attr('data-all-tags').split(' ');
-        const tac = new TagAutoComplete("#tags-input", allTags, {minLength: 2, autoFocus: true});
+        const completeUrl = $("#tags-input").attr('data-complete-url');
+        const tac = new TagAutoComplete("#tags-input", completeUrl, {minLength: 2, autoFocus: true});
+        $(".suggested_tag").on("click", function () {
+            const input = $("#tags-input").get(0);
+            const tags = input.value.split(/\s+/).filter((t) => t);
+            if (!tags.includes($(this).text())) {
+                tags.push($(this).text());
+            }
+            input.value = tags.join(" ") + " ";
+            $(this).remove();
+        });
     }
 });
@@ -7,43 +7,242 @@
 
 import sys
 import os
+import bisect
+import calendar
+import collections
+from collections.abc import Mapping, Sequence
 from dataclasses import dataclass
 import functools
+import heapq
+import importlib
+import json
+import mmap
 import multiprocessing as mp
-import pickle
 import re
 import sqlite3
-import subprocess
+import struct
+import threading
 import time
 from urllib.parse import urlparse
+import xml.etree.ElementTree as ET
 
 
-from bs4 import BeautifulSoup
-from nltk.corpus import stopwords as nltk_stopwords
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import linear_kernel
+import numpy as np
+# scipy.sparse, scikit-learn and NLTK take over a second to import, they are
+# imported where the similarity and tag suggestion code first needs them.
+
+from . import metrics
+from .mdlinks import extract_links
+from .search import parse_query
 
 Sentinel = object()
 
+# Similarity indexes loaded by this process, by DB file name.
+_similarity_indexes = {}
+# TagPrefixIndex and TagSuggester of each DB, by DB file name.
+_tag_indexes = {}
+_tag_suggesters = {}
+
+
+def import_similarity_modules():
+    """Import the modules deferred until first use, e.g. before forking processes that need them"""
+    for name in ('nltk.corpus', 'scipy.sparse', 'sklearn.feature_extraction.text', 'sklearn.preprocessing'):
+        importlib.import_module(name)
+
 
 @functools.lru_cache(maxsize=None)
 def stopwords_from_language(lang):
+    from nltk.corpus import stopwords as nltk_stopwords
     return nltk_stopwords.words(lang)
 
 
-def extract_links(markdown):
-    p = subprocess.run(
-        ['pandoc', '-f', 'commonmark', '-t', 'html'],
-        input=markdown, capture_output=True,
-        encoding='utf-8', check=True)
-    soup = BeautifulSoup(p.stdout, features="lxml")
-    for tag in soup.find_all('a'):
-        href = tag.get('href')
-        if href is not None:
-            yield ''.join(str(c) for c in tag.contents), href
+@functools.lru_cache(maxsize=None)
+def prepare_stopwords(stopwords, stopword_languages):
+    """Merge explicit stopwords with those of `stopword_languages` (both tuples)"""
+    words = list(stopwords or [])
+    for lang in stopword_languages:
+        words.extend(stopwords_from_language(lang))
+    return words
+
+
+@functools.lru_cache(maxsize=None)
+def crosslink_regex(abs_url_prefix):
+    rel_url_prefix = urlparse(abs_url_prefix).path
+    escaped_prefixes = (re.escape(p) for p in [abs_url_prefix, rel_url_prefix])
+    return re.compile(r'^({})/mark\.(\d+)$'.format('|'.join(escaped_prefixes)))
+
+
+_STAR_TAG = re.compile(r'^[0-5]star$')
+
+
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+def _nocase(s):
+    """Key equal for strings that SQLite's NOCASE collation considers equal"""
+    return s.translate(_ASCII_LOWER)
+
+
+def _sql_statements(script):
+    """Split an SQL script into single statements"""
+    stmt = ''
+    for line in script.splitlines(keepends=True):
+        stmt += line
+        if sqlite3.complete_statement(stmt):
+            yield stmt
+            stmt = ''
+    if stmt.strip():
+        yield stmt
+
+
+def _create_fulltext_index(dbconn):
+    """Schema migration step: create and fill the full-text search index `marks_fts`
+
+    The index needs SQLite's FTS5 with the trigram tokenizer, if that's not
+    available, the DB gets no index and searches scan the marks table.
+    """
+    try:
+        dbconn.execute("CREATE VIRTUAL TABLE temp.fts_probe USING fts5(x, tokenize = 'trigram');")
+        dbconn.execute("DROP TABLE temp.fts_probe;")
+    except sqlite3.OperationalError as e:
+        print(f"Warning: Full-text search not available: {e}", file=sys.stderr, flush=True)
+        return
+    dbconn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS marks_fts
+                      USING fts5(title, url, note, tags, tokenize = 'trigram');""")
+    # Older versions created the index outside of the migrations, it may be incomplete.
+    dbconn.execute("DELETE FROM marks_fts;")
+    dbconn.execute("""INSERT INTO marks_fts(rowid, title, url, note, tags)
+                           SELECT mark_id, title, url, note, coalesce(group_concat(tag, ' '), '')
+                             FROM marks
+                        LEFT JOIN mark_tags USING (mark_id)
+                        LEFT JOIN tags USING (tag_id)
+                         GROUP BY mark_id;""")
+
+
+def read_xml_posts(f):
+    """Yield the attributes of each <post> of an export.xml file, parsing it incrementally"""
+    context = ET.iterparse(f, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag == 'post':
+            yield elem.attrib
+            # Drop parsed posts, so memory use doesn't grow with the file size.
+            root.clear()
+
+
+def _parse_post_time(s):
+    if not s:
+        return int(time.time())
+    if s.isdigit():
+        return int(s)
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%SZ'):
+        try:
+            return calendar.timegm(time.strptime(s, fmt))
+        except ValueError:
+            pass
+    raise ValueError(f"Invalid post time: {s!r}")
+
+
+def search_to_sql(search, params):
+    """Translate a parsed SearchStrParser query of `tag:` needles into an SQL condition on `marks`
+
+    The condition matches exactly the marks for which the query is true with
+    Bookmark.contains() semantics: `tag:` needles must equal one of the tags.
+    Queries with plain needles are checked by the py_search() SQL function
+    instead. Needle values are added to the `params` dict as named parameters.
+    """
+    def needle(s):
+        if not s.startswith('tag:'):
+            raise ValueError(f"Not a tag needle: {s!r}")
+        name = f'q{len(params)}'
+        params[name] = s[4:]
+        return f"""EXISTS (SELECT 1 FROM mark_tags AS mt JOIN tags AS t USING (tag_id)
+                            WHERE mt.mark_id = marks.mark_id AND t.tag = :{name} COLLATE BINARY)"""
+
+    return search.fold(needle,
+                       not_=lambda x: f"NOT {x}",
+                       and_=lambda lhs, rhs: f"({lhs} AND {rhs})",
+                       or_=lambda lhs, rhs: f"({lhs} OR {rhs})")
+
+
+# Lowercase characters that the trigram tokenizer folds the same as str.lower().
+# SQLite's case folding tables are older than Python's and fold no character to
+# two, e.g. 'İ'.lower() is 'i' plus a combining dot, which FTS5 never matches.
+_FTS_FOLDABLE = re.compile('[\x00-\u024f\u0370-\u03f2\u03f4-\u04ff]*')
+
+
+def search_to_fts(search):
+    """Translate a parsed SearchStrParser query into an FTS5 query for `marks_fts`
+
+    The trigram index can only look up substrings of three or more characters
+    and negations can't be looked up at all, so the FTS5 query matches a
+    superset of the marks matching `search`; get_marks() narrows it down.
+    Needles with characters the index may fold differently from str.lower()
+    aren't looked up either. Returns None if the FTS5 query can't narrow down
+    the result at all.
+    """
+    def needle(s):
+        column = ''
+        if s.startswith('tag:'):
+            column, s = 'tags : ', s[4:]
+        if len(s) < 3 or not _FTS_FOLDABLE.fullmatch(s.lower()):
+            return None
+        return column + '"' + s.replace('"', '""') + '"'
+
+    def and_(lhs, rhs):
+        if lhs is None or rhs is None:
+            return lhs or rhs
+        return f"({lhs} AND {rhs})"
+
+    def or_(lhs, rhs):
+        if lhs is None or rhs is None:
+            return None
+        return f"({lhs} OR {rhs})"
+
+    return search.fold(needle, not_=lambda x: None, and_=and_, or_=or_)
+
+
+def _only_tag_needles(search):
+    return search.fold(lambda s: s.startswith('tag:'),
+                       not_=lambda x: x,
+                       and_=lambda lhs, rhs: lhs and rhs,
+                       or_=lambda lhs, rhs: lhs and rhs)
+
+
+def _search_needle(s):
+    if s.startswith('tag:'):
+        tag = s[4:]
+        return lambda fields: tag in fields[3]
+    s = s.lower()
+    if ' ' in s:
+        # Must not match across two tags.
+        return lambda fields: (s in fields[0] or s in fields[1] or s in fields[2] or
+                               any(s in tag for tag in fields[4].split(' ')))
+    return lambda fields: s in fields[0] or s in fields[1] or s in fields[2] or s in fields[4]
+
+
+@functools.lru_cache(maxsize=256)
+def search_predicate(query):
+    """Compile a search string into a predicate with Bookmark.contains() semantics
+
+    The predicate takes a tuple of the mark's lowercased title, url and note,
+    its list of tags and its lowercased, space-separated tags.
+    """
+    return parse_query(query).compile(_search_needle)
+
+
+def _py_search(query, title, url, note, tags):
+    return search_predicate(query)(((title or '').lower(), url.lower(), (note or '').lower(),
+                                    tags.split(' ') if tags else [], (tags or '').lower()))
 
 
 class Bookmark:
+    """A bookmark as shown and edited by the views
+
+    Fields are meant to be changed through update(), which resets the cached
+    star rating and lower-cased text.
+    """
+    __slots__ = ('id', 'title', 'url', '_tags', 'note', 'time', 'incoming_links', '_stars', '_lowered')
+
     def __init__(self, *, id=None, title=None, url=None, tags=None, note=None, time=None, incoming_links=None):
         incoming_links = incoming_links or []
         self.update(id=id, title=title, url=url, tags=tags, note=note, time=time, incoming_links=incoming_links)
@@ -64,6 +263,7 @@ class Bookmark:
             self.time = time
         if incoming_links is not Sentinel:
             self.incoming_links = incoming_links
+        self._lowered = None
 
     @property
     def tags(self):
@@ -74,12 +274,15 @@ class Bookmark:
         if isinstance(tags, str):
             tags = [t for t in tags.split(' ') if t]
         self._tags = tags
+        self._stars = None
+        self._lowered = None
 
     @property
     def stars(self):
-        matching_tags = [re.match(r'^([0-5])star$', tag) for tag in self.tags]
-        star_list = [int(m.group(1)) for m in matching_tags if m]
-        return max(star_list, default=0)
+        if self._stars is None:
+            star_list = [int(tag[0]) for tag in self.tags or () if _STAR_TAG.match(tag)]
+            self._stars = max(star_list, default=0)
+        return self._stars
 
     def __eq__(self, rhs):
         if self.id is not None:
@@ -103,14 +306,26 @@ class Bookmark:
         title, url, notes, or within one of the tags).
         If string is not found, False is returned.
         """
+        if self._lowered is None:
+            self._lowered = (self.title.lower(), self.url.lower(), self.note.lower(),
+                             [tag.lower() for tag in self.tags])
+        title, url, note, tags = self._lowered
         string = string.lower()
-        return (string in self.title.lower() or
-                string in self.url.lower() or
-                string in self.note.lower() or
-                any(tag for tag in self.tags if string in tag.lower())
+        return (string in title or
+                string in url or
+                string in note or
+                any(tag for tag in tags if string in tag)
                )
 
 
+class MarkRow(collections.namedtuple('MarkRow', ['id', 'time', 'title', 'url', 'note', 'tags'])):
+    """A bookmark as stored, for code paths going through many marks
+
+    A plain tuple, `tags` is the space-separated string of tag names.
+    """
+    __slots__ = ()
+
+
 @dataclass
 class SlimBookmark:
     '''Rudimentary bookmark information: id, title, url'''
@@ -130,54 +345,304 @@ class Tag:
         return self.name
 
 
+class TagPrefixIndex:
+    """Tags sorted by lower-cased name, to look up the most used tags with a given prefix"""
+
+    def __init__(self, tags, change_id):
+        tags = sorted(tags, key=lambda t: t.name.lower())
+        self.keys = [t.name.lower() for t in tags]
+        self.tags = tags
+        self.change_id = change_id
+
+    def complete(self, prefix, num=10):
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + '\U0010ffff', start)
+        candidates = (self.tags[i] for i in range(start, end))
+        return heapq.nlargest(num, candidates, key=lambda t: t.num_marks)
+
+
+class TagSuggester:
+    """Suggests tags from the tags of similar marks and from tags used together
+
+    Each tag scores the similarity-weighted share of the neighbour marks that
+    have it, plus, by CO_OCCURRENCE_WEIGHT, how often it appears together with
+    the tags the mark already has. The background similarity refresh saves
+    it next to the similarity index, from where processes map it.
+    """
+    CO_OCCURRENCE_WEIGHT = 0.5
+    FILE_MAGIC = b'KB3TAGSG'
+    FORMAT_VERSION = 1
+
+    def __init__(self, mark_tags, change_id):
+        """`mark_tags` are (mark ID, tag) pairs"""
+        from scipy.sparse import csr_matrix
+        self.mark_rows = {}
+        self.tag_names = []
+        tag_columns = {}
+        rows, columns = [], []
+        for mark_id, tag in mark_tags:
+            rows.append(self.mark_rows.setdefault(mark_id, len(self.mark_rows)))
+            if _nocase(tag) not in tag_columns:
+                tag_columns[_nocase(tag)] = len(self.tag_names)
+                self.tag_names.append(tag)
+            columns.append(tag_columns[_nocase(tag)])
+        self.tag_columns = tag_columns
+        self.marks_tags = csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)),
+                                     shape=(len(self.mark_rows), len(self.tag_names)))
+        # Row t: the share of the marks tagged t that also have each other tag.
+        co_occurrences = (self.marks_tags.T @ self.marks_tags).tocsr()
+        tag_counts = co_occurrences.diagonal()
+        co_occurrences.setdiag(0)
+        co_occurrences.eliminate_zeros()
+        self.co_occurrences = csr_matrix(co_occurrences.multiply(1 / np.maximum(tag_counts, 1)[:, None]))
+        self.change_id = change_id
+
+    def save(self, fname, change_id):
+        """Atomically (re)write the suggester file, as of DB state `change_id`"""
+        self.change_id = change_id
+        mark_ids = np.array(sorted(self.mark_rows), dtype=np.int64)
+        # Sorted as UTF-8, which is the same order as sorting by code points.
+        tag_columns = sorted((t.encode('utf-8'), col) for t, col in self.tag_columns.items())
+        arrays = {
+            'mark_rows.ids': mark_ids,
+            'mark_rows.rows': np.array([self.mark_rows[id] for id in mark_ids], dtype=np.int64),
+            'tag_columns.terms': np.frombuffer(b''.join(t for t, _ in tag_columns), dtype=np.uint8),
+            'tag_columns.term_ends': np.cumsum([len(t) for t, _ in tag_columns], dtype=np.int64),
+            'tag_columns.term_cols': np.array([col for _, col in tag_columns], dtype=np.int64),
+        }
+        for name in ('marks_tags', 'co_occurrences'):
+            matrix = getattr(self, name)
+            arrays.update({
+                name + '.indptr': matrix.indptr,
+                name + '.indices': matrix.indices,
+                name + '.data': matrix.data,
+            })
+        _save_array_file(fname, self.FILE_MAGIC, self.FORMAT_VERSION, arrays, dict(
+            change_id=change_id,
+            tag_names=self.tag_names,
+        ))
+
+    @classmethod
+    def load(cls, fname):
+        from scipy.sparse import csr_matrix
+        buf, header, arrays, offsets = _load_array_file(fname, cls.FILE_MAGIC, cls.FORMAT_VERSION, "tag suggester")
+        suggester = cls.__new__(cls)
+        suggester.change_id = header['change_id']
+        suggester.tag_names = header['tag_names']
+        suggester.mark_rows = _IdRows(arrays['mark_rows.ids'], arrays['mark_rows.rows'])
+        suggester.tag_columns = _SortedVocabulary(buf, offsets['tag_columns.terms'],
+                                                  arrays['tag_columns.term_ends'], arrays['tag_columns.term_cols'])
+        for name, shape in [('marks_tags', (len(suggester.mark_rows), len(suggester.tag_names))),
+                            ('co_occurrences', (len(suggester.tag_names), len(suggester.tag_names)))]:
+            setattr(suggester, name, csr_matrix(
+                (arrays[name + '.data'], arrays[name + '.indices'], arrays[name + '.indptr']), shape=shape))
+        return suggester
+
+    @classmethod
+    def load_if_valid(cls, fname):
+        """Like load(), but return None if the file is missing or unreadable"""
+        try:
+            return cls.load(fname)
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"Warning: Ignoring tag suggester: {e}", file=sys.stderr, flush=True)
+            return None
+
+    def suggest(self, similar, tags, num=10):
+        """Best `num` tags for a mark with the `tags`, and (ID, score) of its `similar` marks"""
+        scores = np.zeros(len(self.tag_names), dtype=np.float32)
+        similar = [(self.mark_rows[id], score) for id, score in similar if id in self.mark_rows and score > 0]
+        if similar:
+            rows, weights = zip(*similar)
+            weights = np.array(weights, dtype=np.float32)
+            scores += weights / weights.sum() @ self.marks_tags[list(rows)]
+        known = [self.tag_columns[_nocase(t)] for t in tags if _nocase(t) in self.tag_columns]
+        if known:
+            scores += self.CO_OCCURRENCE_WEIGHT * np.asarray(self.co_occurrences[known].mean(axis=0)).ravel()
+        scores[known] = 0
+        best = np.argsort(-scores, kind='stable')[:num]
+        return [self.tag_names[i] for i in best if scores[i] > 0]
+
+
 class BookmarkDB:
-    def __init__(self, dbfname, abs_url_prefix, stopwords=None, stopword_languages=None, ignore_hosts_in_search=()):
+    def __init__(self, dbfname, abs_url_prefix, stopwords=None, stopword_languages=None, ignore_hosts_in_search=(),
+                 refresh_debounce=2.0, refresh_max_staleness=30.0, precompute_similar=10):
         self.dbfname = dbfname
-        must_create_schema = not os.path.isfile(self.dbfname)
+        self.similarity_index_fname = dbfname + '.simidx'
+        self.tag_suggester_fname = dbfname + '.tagsug'
 
-        self.dbconn = sqlite3.connect(self.dbfname)
+        # Handles may be pooled and closed by a different thread than the one using them.
+        self.dbconn = sqlite3.connect(self.dbfname, check_same_thread=False, factory=metrics.TimedConnection)
         self.dbconn.row_factory = sqlite3.Row
-        self.dbconn.execute("PRAGMA foreign_keys = ON;")
+        self.dbconn.executescript(self.CONNECTION_PRAGMAS)
+        # SQLite's lower() only folds ASCII, text searches must match str.lower().
+        self.dbconn.create_function('py_search', 5, _py_search, deterministic=True)
 
         self.cache = DBCache(self.dbconn)
-        if must_create_schema:
-            self._create_schema()
-            self.cache.create_schema()
+        self._upgrade_schema()
+        self.has_fulltext = bool(self.dbconn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'marks_fts';").fetchone())
 
         self.abs_url_prefix = abs_url_prefix
-        rel_url_prefix = urlparse(abs_url_prefix).path
-        escaped_prefixes = (re.escape(p) for p in [abs_url_prefix, rel_url_prefix])
-        self.crosslink_regex = re.compile(r'^({})/mark\.(\d+)$'.format('|'.join(escaped_prefixes)))
+        self.crosslink_regex = crosslink_regex(abs_url_prefix)
 
-        self.stopwords = stopwords
-        if stopword_languages:
-            self.stopwords = list(self.stopwords or [])
-            self.stopwords.extend(
-                w for lang in stopword_languages
-                    for w in stopwords_from_language(lang))
+        self._stopwords = stopwords
+        self.stopword_languages = stopword_languages
         self.ignore_hosts_in_search = ignore_hosts_in_search
+        self.refresh_debounce = refresh_debounce
+        self.refresh_max_staleness = refresh_max_staleness
+        self.precompute_similar = precompute_similar
 
-    def _create_schema(self):
-        self.dbconn.executescript("""
-            CREATE TABLE marks(
+    @property
+    def stopwords(self):
+        """Explicit stopwords plus those of the stopword languages, loaded from NLTK on first use"""
+        if self.stopword_languages:
+            return prepare_stopwords(tuple(self._stopwords or ()), tuple(self.stopword_languages))
+        return self._stopwords
+
+    def warm_up(self):
+        """Load what the first requests would otherwise wait for
+
+        Imports the similarity modules, loads (or, if none was saved yet, builds)
+        the similarity index and builds the tag indexes, and reads the pages
+        of the first mark list into the OS cache.
+        """
+        import_similarity_modules()
+        search = self._similarity_search()
+        for index in search.columns.values():
+            index.analyzer      # Built on first use
+        self.complete_tag('')
+        self._tag_suggester()
+        self.get_marks(limit=100)
+
+    def close(self):
+        # Keeps the query planner's statistics up to date, cheap if there's nothing to do.
+        self.dbconn.execute("PRAGMA optimize;")
+        self.dbconn.close()
+
+    # WAL lets readers go on while the similarity refresh writes. With WAL,
+    # synchronous = NORMAL can only lose the last commits on power loss.
+    CONNECTION_PRAGMAS = """
+        PRAGMA foreign_keys = ON;
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+        PRAGMA cache_size = -16384;                      -- KiB
+        PRAGMA mmap_size = 268435456;
+    """
+
+    # SCHEMA_MIGRATIONS[i] upgrades a DB from `PRAGMA user_version` i to i + 1,
+    # either an SQL script or a function called with the connection. Version 1
+    # is the schema as it was before versioning, so it has to work on any older
+    # DB, too.
+    SCHEMA_MIGRATIONS = (
+        """
+            CREATE TABLE IF NOT EXISTS marks(
                 mark_id INTEGER PRIMARY KEY,
                 time INTEGER NOT NULL,
                 title TEXT COLLATE NOCASE,
                 url TEXT NOT NULL,
                 note TEXT
             );
-            CREATE TABLE tags(
+            CREATE TABLE IF NOT EXISTS tags(
                 tag_id INTEGER PRIMARY KEY,
                 tag TEXT UNIQUE NOT NULL COLLATE NOCASE
             );
-            CREATE TABLE mark_tags(
+            CREATE TABLE IF NOT EXISTS mark_tags(
                 mark_id INTEGER NOT NULL,
                 tag_id INTEGER NOT NULL,
                 PRIMARY KEY (mark_id, tag_id),
                 FOREIGN KEY (mark_id) REFERENCES marks(mark_id) ON DELETE CASCADE,
                 FOREIGN KEY (tag_id) REFERENCES tags(tag_id) ON DELETE CASCADE
             );
-        """)
+            CREATE TABLE IF NOT EXISTS mark_crosslinks(
+                source_id INTEGER NOT NULL,               -- mark whose note contains the link
+                destination_id INTEGER NOT NULL,          -- linked mark
+                link_title TEXT,
+                PRIMARY KEY (source_id, destination_id)
+            );
+            CREATE TABLE IF NOT EXISTS cache(
+                key TEXT UNIQUE NOT NULL,                 -- cache key
+                value BLOB,                               -- cached value
+                change_id INTEGER NOT NULL DEFAULT 0,     -- incremented on any DB write
+                refresh_id INTEGER NOT NULL DEFAULT -1,   -- equals change_id if up to date
+
+                PRIMARY KEY (key)
+            );
+            CREATE TABLE IF NOT EXISTS mark_changes(
+                mark_id INTEGER PRIMARY KEY,              -- added, edited, or deleted mark
+                change_id INTEGER NOT NULL                -- change_id of its last write
+            );
+            CREATE INDEX IF NOT EXISTS mark_changes_change_id ON mark_changes(change_id);
+            CREATE TABLE IF NOT EXISTS mark_similar(
+                mark_id INTEGER NOT NULL,
+                rank INTEGER NOT NULL,                    -- 0 for the most similar mark
+                similar_id INTEGER NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (mark_id, rank)
+            ) WITHOUT ROWID;
+
+            -- Make sure change_id is counted even before anything is cached.
+            INSERT OR IGNORE INTO cache(key, change_id)
+                SELECT 'version', coalesce(max(change_id), 0) FROM cache;
+        """,
+        """
+            -- Marks of a tag, marks by URL, and links to a mark.
+            CREATE INDEX IF NOT EXISTS mark_tags_tag_id ON mark_tags(tag_id, mark_id);
+            CREATE INDEX IF NOT EXISTS marks_url ON marks(url);
+            CREATE INDEX IF NOT EXISTS mark_crosslinks_destination_id ON mark_crosslinks(destination_id);
+        """,
+        """
+            -- Number of marks per tag, kept up to date by triggers. Tags
+            -- without marks are deleted by the write path.
+            ALTER TABLE tags ADD COLUMN num_marks INTEGER NOT NULL DEFAULT 0;
+            UPDATE tags SET num_marks = (SELECT count(*) FROM mark_tags WHERE mark_tags.tag_id = tags.tag_id);
+            DELETE FROM tags WHERE num_marks = 0;
+            CREATE INDEX tags_num_marks ON tags(num_marks);
+
+            CREATE TRIGGER mark_tags_insert AFTER INSERT ON mark_tags BEGIN
+                UPDATE tags SET num_marks = num_marks + 1 WHERE tag_id = NEW.tag_id;
+            END;
+            CREATE TRIGGER mark_tags_delete AFTER DELETE ON mark_tags BEGIN
+                UPDATE tags SET num_marks = num_marks - 1 WHERE tag_id = OLD.tag_id;
+            END;
+            CREATE TRIGGER mark_tags_update AFTER UPDATE OF tag_id ON mark_tags BEGIN
+                UPDATE tags SET num_marks = num_marks - 1 WHERE tag_id = OLD.tag_id;
+                UPDATE tags SET num_marks = num_marks + 1 WHERE tag_id = NEW.tag_id;
+            END;
+        """,
+        _create_fulltext_index,
+    )
+
+    def _upgrade_schema(self):
+        """Create the DB schema or upgrade it to the current version"""
+        # Usually there's nothing to do, which is checked without taking the
+        # write lock, so opening a DB doesn't wait for writers.
+        if self.dbconn.execute("PRAGMA user_version;").fetchone()[0] == len(self.SCHEMA_MIGRATIONS):
+            return
+        while True:
+            # Each step is a transaction of its own, so a failed upgrade leaves a
+            # consistent DB. The version is read again within it, so concurrent
+            # opens don't run a step twice.
+            self.dbconn.execute("BEGIN IMMEDIATE;")
+            try:
+                version = self.dbconn.execute("PRAGMA user_version;").fetchone()[0]
+                if version > len(self.SCHEMA_MIGRATIONS):
+                    raise RuntimeError(f"{self.dbfname}: Schema version {version} is newer than this program")
+                if version == len(self.SCHEMA_MIGRATIONS):
+                    self.dbconn.commit()
+                    return
+                step = self.SCHEMA_MIGRATIONS[version]
+                if callable(step):
+                    step(self.dbconn)
+                else:
+                    for stmt in _sql_statements(step):
+                        self.dbconn.execute(stmt)
+                self.dbconn.execute(f"PRAGMA user_version = {version + 1};")
+                self.dbconn.commit()
+            except BaseException:
+                self.dbconn.rollback()
+                raise
 
     def add(self, title, url, note, tags):
         mark_id = self._insert(Bookmark(title=title, url=url, note=note, tags=tags, time=int(time.time())))
@@ -203,12 +668,14 @@ class BookmarkDB:
             t_id = cur.execute("SELECT tag_id FROM tags WHERE tag = ?;", (tag,)).fetchone()[0]
             cur.execute("INSERT INTO mark_tags VALUES (?, ?);", (mark.id, t_id))
         self._save_crosslinks(mark, cur)
-        self.cache.invalidate_cursor(cur)
+        self._save_fulltext(mark, cur)
+        self.cache.invalidate_cursor(cur, mark_ids=[mark.id])
         self.dbconn.commit()
         return mark.id
 
     def _update(self, mark):
         cur = self.dbconn.cursor()
+        old = cur.execute("SELECT note FROM marks WHERE mark_id = ?;", (mark.id,)).fetchone()
         cur.execute("""UPDATE marks SET time = ?, title = ?, url = ?, note = ?
                               WHERE mark_id = ?;""",
                     (mark.time, mark.title, mark.url, mark.note, mark.id))
@@ -222,28 +689,165 @@ class BookmarkDB:
             cur.execute("SELECT tag_id FROM tags WHERE tag = ?;", (tag,))
             t_id = cur.fetchone()[0]
             cur.execute("INSERT INTO mark_tags VALUES (?,?);", (mark.id, t_id))
-        cur.execute("""DELETE FROM tags WHERE tag_id NOT IN
-                              (SELECT mark_tags.tag_id FROM mark_tags);""")
-        self._save_crosslinks(mark, cur)
-        self.cache.invalidate_cursor(cur)
+        cur.execute("DELETE FROM tags WHERE num_marks = 0;")
+        if old is None or old['note'] != mark.note:
+            self._save_crosslinks(mark, cur)
+        self._save_fulltext(mark, cur)
+        self.cache.invalidate_cursor(cur, mark_ids=[mark.id])
         self.dbconn.commit()
         return mark.id
 
     def _save_crosslinks(self, mark, cur):
         cur.execute("DELETE FROM mark_crosslinks WHERE source_id = ?", (mark.id,))
-        for link_title, url in extract_links(mark.note):
+        cur.executemany("INSERT OR REPLACE INTO mark_crosslinks VALUES (?, ?, ?);",
+                        [(mark.id, dest_id, link_title) for link_title, dest_id in self._crosslinks(mark.note)])
+
+    def _crosslinks(self, note):
+        """Yield (link text, mark ID) of the links to other marks in `note`"""
+        with metrics.timer('extract_links'):
+            links = list(extract_links(note))
+        for link_title, url in links:
             m = self.crosslink_regex.match(url)
             if m:
-                cur.execute("INSERT OR REPLACE INTO mark_crosslinks VALUES (?, ?, ?);",
-                            (mark.id, m.group(2), link_title))
+                yield link_title, int(m.group(2))
+
+    def reindex_crosslinks(self):
+        """Rebuild the crosslinks of all marks in one transaction, return their number"""
+        rows = self.dbconn.execute("SELECT mark_id, note FROM marks;").fetchall()
+        # As in _save_crosslinks(), the last link to the same mark wins.
+        links = {(row['mark_id'], dest_id): (row['mark_id'], dest_id, link_title)
+                 for row in rows
+                     for link_title, dest_id in self._crosslinks(row['note'])}
+        cur = self.dbconn.cursor()
+        cur.execute("DELETE FROM mark_crosslinks;")
+        cur.executemany("INSERT INTO mark_crosslinks VALUES (?, ?, ?);", links.values())
+        self.cache.invalidate_cursor(cur)
+        self.dbconn.commit()
+        return len(links)
+
+    def import_xml(self, fname, *, batch_size=1000, progress=None):
+        """Add all posts of an export.xml file in one transaction, return their number
+
+        Posts are expected newest first, as exported, and are numbered so
+        that they keep this order. Marks are inserted in batches of
+        `batch_size`, crosslinks are stored once everything is in.
+        `progress(num_imported)` is called after each batch. The similarity
+        cache is left to the caller, e.g. update_similarity_cache().
+
+        Links to other marks in the notes are rewritten from the exported
+        mark IDs, the posts' `id` attributes, to the new ones; links to marks
+        not in the file aren't crosslinks. Files exported without IDs keep
+        their links as they are, which only point to the right marks when
+        imported into an empty database from one without gaps in its IDs.
+        """
+        with open(fname, 'rb') as f:
+            old_ids = [post.get('id') for post in read_xml_posts(f)]
+        num_posts = len(old_ids)
+
+        cur = self.dbconn.cursor()
+        cur.execute("BEGIN IMMEDIATE;")
+        try:
+            first_id = cur.execute("SELECT coalesce(max(mark_id), 0) + 1 FROM marks;").fetchone()[0]
+            tag_ids = {_nocase(row['tag']): row['tag_id']
+                       for row in cur.execute("SELECT tag, tag_id FROM tags;")}
+            next_tag_id = cur.execute("SELECT coalesce(max(tag_id), 0) + 1 FROM tags;").fetchone()[0]
+
+            # Posts are numbered from the last one.
+            id_map = {int(old_id): first_id + num_posts - 1 - i
+                      for i, old_id in enumerate(old_ids) if old_id is not None}
+            mark_id = first_id + num_posts
+            batch = collections.defaultdict(list)
+            links = []
+            with open(fname, 'rb') as f:
+                for post in read_xml_posts(f):
+                    mark_id -= 1
+                    url = post['href']
+                    title = post.get('description') or url
+                    note = post.get('extended', '')
+                    if id_map:
+                        note, note_links = self._remap_crosslinks(note, id_map)
+                        links.extend((mark_id, dest_id, link_title) for link_title, dest_id in note_links)
+                    mark_time = _parse_post_time(post.get('time'))
+                    tags = list({_nocase(t): t for t in post.get('tag', '').split(' ') if t}.values())
+                    for tag in tags:
+                        if _nocase(tag) not in tag_ids:
+                            tag_ids[_nocase(tag)] = next_tag_id
+                            batch['tags'].append((next_tag_id, tag))
+                            next_tag_id += 1
+                        batch['mark_tags'].append((mark_id, tag_ids[_nocase(tag)]))
+                    batch['marks'].append((mark_id, mark_time, title, url, note))
+                    batch['fulltext'].append((mark_id, title, url, note, ' '.join(tags)))
+                    if len(batch['marks']) >= batch_size:
+                        self._import_batch(cur, batch)
+                        if progress:
+                            progress(first_id + num_posts - mark_id)
+                if batch['marks']:
+                    self._import_batch(cur, batch)
+                    if progress:
+                        progress(num_posts)
+
+            new_ids = range(first_id, first_id + num_posts)
+            if not id_map:
+                links = [(row['mark_id'], dest_id, link_title)
+                         for row in cur.execute("SELECT mark_id, note FROM marks WHERE mark_id >= ?;", (first_id,))
+                             for link_title, dest_id in self._crosslinks(row['note'])]
+            cur.executemany("INSERT OR REPLACE INTO mark_crosslinks VALUES (?, ?, ?);", links)
+            self.cache.invalidate_cursor(cur, mark_ids=new_ids)
+            self.dbconn.commit()
+        except BaseException:
+            self.dbconn.rollback()
+            raise
+        return num_posts
+
+    def _remap_crosslinks(self, note, id_map):
+        """Point the links of `note` to marks in `id_map` to their mapped IDs
+
+        Returns the rewritten note and the (link text, mapped mark ID) of
+        these links, links to other marks are left alone.
+        """
+        new_urls, links = {}, []
+        with metrics.timer('extract_links'):
+            note_links = list(extract_links(note))
+        for link_title, url in note_links:
+            m = self.crosslink_regex.match(url)
+            if m and int(m.group(2)) in id_map:
+                dest_id = id_map[int(m.group(2))]
+                new_urls[url] = f"{m.group(1)}/mark.{dest_id}"
+                links.append((link_title, dest_id))
+        if not new_urls:
+            return note, links
+        # In one pass, so a rewritten link isn't rewritten again; mark.1 must not match mark.12.
+        pattern = '|'.join(re.escape(url) + r'(?!\d)' for url in sorted(new_urls, key=len, reverse=True))
+        return re.sub(pattern, lambda m: new_urls[m.group(0)], note), links
+
+    def _import_batch(self, cur, batch):
+        cur.executemany("INSERT INTO tags(tag_id, tag) VALUES (?, ?);", batch['tags'])
+        cur.executemany("INSERT INTO marks(mark_id, time, title, url, note) VALUES (?, ?, ?, ?, ?);",
+                        batch['marks'])
+        cur.executemany("INSERT INTO mark_tags VALUES (?, ?);", batch['mark_tags'])
+        if self.has_fulltext:
+            cur.executemany("INSERT INTO marks_fts(rowid, title, url, note, tags) VALUES (?, ?, ?, ?, ?);",
+                            batch['fulltext'])
+        batch.clear()
+
+    def _save_fulltext(self, mark, cur):
+        if not self.has_fulltext:
+            return
+        tags = ' '.join(t for t in (tag.strip() for tag in mark.tags) if t)
+        cur.execute("DELETE FROM marks_fts WHERE rowid = ?;", (mark.id,))
+        cur.execute("INSERT INTO marks_fts(rowid, title, url, note, tags) VALUES (?, ?, ?, ?, ?);",
+                    (mark.id, mark.title, mark.url, mark.note, tags))
 
     def delete(self, mark):
         cur = self.dbconn.cursor()
         cur.execute("""DELETE FROM marks WHERE mark_id = ?;""", (mark.id,))
+        if self.has_fulltext:
+            cur.execute("""DELETE FROM marks_fts WHERE rowid = ?;""", (mark.id,))
         cur.execute("""DELETE FROM mark_crosslinks WHERE source_id = ?""", (mark.id,))
-        cur.execute("""DELETE FROM tags WHERE tag_id NOT IN
-                              (SELECT mark_tags.tag_id FROM mark_tags);""")
+        cur.execute("DELETE FROM tags WHERE num_marks = 0;")
+        self.cache.invalidate_cursor(cur, mark_ids=[mark.id])
         self.dbconn.commit()
+        self.async_update_similarity_cache()
 
     def get_successors(self, mark_id=None, count=1):
         stmt = """SELECT * FROM (
@@ -270,55 +874,146 @@ class BookmarkDB:
         rows = self.dbconn.execute(stmt, { 'mark_id': mark_id, 'count': count })
         return [self._mark_from_dbrow(row) for row in rows]
 
+    def get_neighbor_ids(self, mark_id):
+        """IDs of the marks right before and after `mark_id` (None if there are none)"""
+        row = self.dbconn.execute(
+                """SELECT (SELECT max(mark_id) FROM mark_tags WHERE mark_id < :mark_id),
+                          (SELECT min(mark_id) FROM mark_tags WHERE mark_id > :mark_id);""",
+                {'mark_id': mark_id}).fetchone()
+        return row[0], row[1]
+
     def _mark_from_dbrow(self, row):
         return Bookmark(id=row["mark_id"], title=row["title"], url=row["url"],
                         note=row["note"], tags=row["tags"].split(), time=row["time"])
 
-    def get_marks(self, *, limit=-1, offset=0, mark_id=None, not_mark_id=None, tag=None, url=None):
+    def get_marks(self, *, limit=-1, offset=0, before_id=None, after_id=None, mark_id=None, mark_ids=None,
+                  not_mark_id=None, tag=None, url=None, query=None, by_relevance=False):
+        """Load bookmarks, newest first
+
+        `query` is an optional parsed SearchStrParser, only matching marks are
+        returned. With `by_relevance`, these are sorted by their BM25 rank
+        instead, as far as the full-text index can rank the query.
+
+        `mark_ids` restricts the result to these marks and returns them in the
+        given order; IDs of marks that don't exist are skipped.
+
+        For paging, `before_id` returns the `limit` marks right before (older
+        than) that mark, `after_id` the `limit` marks right after it. Unlike
+        `offset`, these don't need to skip over all earlier rows.
+        """
+        args = dict(
+            mark_id=mark_id,
+            not_mark_id=not_mark_id,
+            before_id=before_id,
+            after_id=after_id,
+            tag=tag,
+            url=url,
+            limit=limit,
+            offset=offset,
+        )
         where_clauses = ["1=1"]
         if mark_id is not None:
             where_clauses.append('mark_id = :mark_id')
         if not_mark_id is not None:
             where_clauses.append('mark_id != :not_mark_id')
+        id_bounds = []
+        if before_id is not None:
+            id_bounds.append('mark_id < :before_id')
+        if after_id is not None:
+            id_bounds.append('mark_id > :after_id')
+        where_clauses.extend(id_bounds)
         if tag is not None:
-            where_clauses.append('''mark_id in (SELECT mark_id FROM mark_tags
-                                                JOIN tags USING (tag_id)
-                                                WHERE tag = :tag)''')
+            # Bounded as well, so deeper pages build a smaller list of the tag's marks.
+            where_clauses.append(f'''mark_id in (SELECT mark_id FROM mark_tags
+                                                 JOIN tags USING (tag_id)
+                                                 WHERE {' AND '.join(['tag = :tag'] + id_bounds)})''')
         if url is not None:
             where_clauses.append('url = :url')
+        ids_join = ''
+        fulltext_join = ''
+        # The marks closest to `after_id` come first, they are put back in order below.
+        sorter = 'mark_id ASC' if after_id is not None else 'mark_id DESC'
+        if mark_ids is not None:
+            args['mark_ids'] = json.dumps(list(dict.fromkeys(int(id) for id in mark_ids)))
+            ids_join = "JOIN json_each(:mark_ids) AS wanted ON wanted.value = marks.mark_id"
+            sorter = 'wanted.key ASC'
+        having_clause = ''
+        if query is not None:
+            if _only_tag_needles(query):
+                # Only refers to the `marks` table, so SQLite checks it once per mark, not per tag.
+                where_clauses.append(search_to_sql(query, args))
+            else:
+                # Text needles are checked in one compiled predicate on the grouped row,
+                # instead of a tag subquery per needle.
+                args['search'] = query.full_query
+                having_clause = "HAVING py_search(:search, marks.title, marks.url, marks.note, group_concat(tag, ' '))"
+            args['fts_query'] = search_to_fts(query) if self.has_fulltext else None
+            if args['fts_query'] is not None:
+                # BM25 column weights for title, url, note, tags.
+                fulltext_join = """JOIN (SELECT rowid AS mark_id, rank AS relevance
+                                           FROM marks_fts
+                                          WHERE marks_fts MATCH :fts_query
+                                            AND rank MATCH 'bm25(4.0, 1.0, 1.0, 2.0)') USING (mark_id)"""
+                if by_relevance:
+                    sorter = 'relevance ASC, mark_id DESC'
         stmt = f"""SELECT marks.*, group_concat(tag, ' ') AS tags
                      FROM marks
+                     {ids_join}
                      JOIN mark_tags USING (mark_id)
                      JOIN tags USING (tag_id)
+                     {fulltext_join}
                     WHERE {' AND '.join(where_clauses)}
                  GROUP BY mark_id
-                 ORDER BY mark_id DESC
+                 {having_clause}
+                 ORDER BY {sorter}
                     LIMIT :limit
                    OFFSET :offset;"""
-        args = dict(
-            mark_id=mark_id,
-            not_mark_id=not_mark_id,
-            tag=tag,
-            url=url,
-            limit=limit,
-            offset=offset,
-        )
-        rows = self.dbconn.execute(stmt, args)
+        rows = self.dbconn.execute(stmt, args).fetchall()
         bookmarks = [self._mark_from_dbrow(row) for row in rows]
+        if after_id is not None and sorter == 'mark_id ASC':
+            bookmarks.reverse()
         self._add_incoming_links(bookmarks)
         return bookmarks
 
+    def iter_marks(self, *, mark_ids=None, batch_size=500):
+        """Yield all bookmarks, or those in `mark_ids`, as MarkRows, newest first
+
+        Rows are fetched in batches from a single statement, which also keeps
+        a consistent snapshot of the DB. Incoming links are not loaded.
+        """
+        where_clause = ''
+        if mark_ids is not None:
+            where_clause = 'WHERE mark_id IN (SELECT value FROM json_each(:mark_ids))'
+        cur = self.dbconn.cursor()
+        cur.row_factory = lambda _, row: MarkRow._make(row)
+        cur.execute(f"""SELECT mark_id, time, title, url, note, group_concat(tag, ' ')
+                          FROM marks
+                          JOIN mark_tags USING (mark_id)
+                          JOIN tags USING (tag_id)
+                         {where_clause}
+                      GROUP BY mark_id
+                      ORDER BY mark_id DESC;""",
+                    {'mark_ids': json.dumps(list(mark_ids or ()))})
+        try:
+            while rows := cur.fetchmany(batch_size):
+                yield from rows
+        finally:
+            cur.close()
+
     def _add_incoming_links(self, bookmarks):
         id_bookmark_map = {m.id: m for m in bookmarks}
         for m in bookmarks:
             m.incoming_links = []
+        if not bookmarks:
+            return
 
-        stmt = f"""SELECT mark_crosslinks.destination_id, mark_id, title, url, time
+        # A single JSON parameter, as the number of SQL variables is limited.
+        stmt = """SELECT mark_crosslinks.destination_id, mark_id, title, url, time
                      FROM mark_crosslinks
                      JOIN marks ON mark_crosslinks.source_id = marks.mark_id
-                    WHERE mark_crosslinks.destination_id in ({','.join(['?']*len(id_bookmark_map))})
+                    WHERE mark_crosslinks.destination_id IN (SELECT value FROM json_each(?))
                  ORDER BY marks.mark_id DESC;"""
-        rows = self.dbconn.execute(stmt, list(id_bookmark_map))
+        rows = self.dbconn.execute(stmt, (json.dumps(list(id_bookmark_map)),))
         for dst_id, src_id, src_title, src_url, src_time in rows:
             link = SlimBookmark(src_id, src_title, src_url, src_time)
             id_bookmark_map[dst_id].incoming_links.append(link)
@@ -331,80 +1026,336 @@ class BookmarkDB:
 
     def get_tags(self, sort_by_frequency=False):
         if sort_by_frequency:
-            sorter = "count(mark_id) DESC"
+            sorter = "num_marks DESC"
         else:
             sorter = "tag ASC"
-        rows = self.dbconn.execute(
-                """SELECT tag, count(mark_id) AS cnt FROM tags
-                          JOIN mark_tags USING (tag_id)
-                          GROUP BY tag_id
-                          ORDER BY """ + sorter + ";")
+        rows = self.dbconn.execute("SELECT tag, num_marks FROM tags ORDER BY " + sorter + ";")
         for row in rows:
             yield Tag(row[0], row[1])
 
+    def version(self):
+        """(change_id, time of the last write or None) of the DB, cheap to check for changes"""
+        return self.cache.version()
+
+    def similarity_version(self):
+        """DB states the similarity index and the mark_similar table were last refreshed to"""
+        return (self.cache.refresh_id('similarity'), self.cache.refresh_id('mark_similar'))
+
+    def complete_tag(self, prefix, *, num=10):
+        """The `num` most used tags starting with `prefix`, ignoring case"""
+        change_id = self.cache.change_id()
+        index = _tag_indexes.get(self.dbfname)
+        if index is None or index.change_id != change_id:
+            index = TagPrefixIndex(self.get_tags(), change_id)
+            _tag_indexes[self.dbfname] = index
+        return index.complete(prefix, num)
+
+    def suggest_tags(self, mark, *, num=10, neighbours=20):
+        """Tags that `mark` might need, based on similar marks and its tags"""
+        similar = self._similarity_search().find_similar_scored([mark], num=neighbours)[0]
+        return self._tag_suggester().suggest(similar, mark.tags or [], num)
+
+    @metrics.timed('find_similar')
+    def find_similar_and_suggest_tags(self, mark, *, num=10, num_tags=10, neighbours=20):
+        """find_similar() and suggest_tags() of `mark`, scoring it against the similarity index once"""
+        similar = self._similarity_search().find_similar_scored([mark], num=max(num, neighbours))[0]
+        similar_ids = None
+        if mark.id is not None:
+            similar_ids = self._precomputed_similar_ids(mark.id, num=num)
+        if similar_ids is None:
+            similar_ids = [id for id, _ in similar[:num]]
+        suggested_tags = self._tag_suggester().suggest(similar[:neighbours], mark.tags or [], num_tags)
+        return self.get_marks(mark_ids=similar_ids), suggested_tags
+
+    def _tag_suggester(self):
+        """The tag suggester saved by the last similarity refresh, mapped from disk when it changed
+
+        Like the mark_similar table, it lags behind writes until the next
+        refresh. It is only built here if no refresh has saved one yet.
+        """
+        refresh_id = self.cache.refresh_id('tag_suggester')
+        suggester = _tag_suggesters.get(self.dbfname)
+        if suggester is not None and (refresh_id is None or suggester.change_id == refresh_id):
+            return suggester
+        if refresh_id is not None:
+            loaded = TagSuggester.load_if_valid(self.tag_suggester_fname)
+            if loaded is not None and loaded.change_id == refresh_id:
+                suggester = loaded
+        if suggester is None:
+            print("Warning: No saved tag suggester found", file=sys.stderr, flush=True)
+            suggester = self._refresh_tag_suggester(self.cache.change_id())
+        _tag_suggesters[self.dbfname] = suggester
+        return suggester
+
+    def _refresh_tag_suggester(self, change_id):
+        """Build and save the tag suggester, as of DB state `change_id`"""
+        rows = self.dbconn.execute("SELECT mark_id, tag FROM mark_tags JOIN tags USING (tag_id);")
+        suggester = TagSuggester(rows, change_id)
+        suggester.save(self.tag_suggester_fname, change_id)
+        self.cache.set('tag_suggester', None, change_id=change_id)
+        return suggester
+
+    @metrics.timed('find_similar')
     def find_similar(self, mark, *, num=10):
-        cached_search = self.cache.get('similarity')
-        if cached_search:
-            search = SimilaritySearch.deserialize(cached_search)
-        else:
-            print("Warning: Out-of-date similarity cache found", file=sys.stderr, flush=True)
-            search = self._refresh_similarity_cache()
-        similar_ids = search.find_similar_ids(mark, num=num)
-        return [m
-                for id in similar_ids
-                    for m in self.get_marks(mark_id=id)]
+        similar_ids = None
+        if mark.id is not None:
+            similar_ids = self._precomputed_similar_ids(mark.id, num=num)
+        if similar_ids is None:
+            similar_ids = self._similarity_search().find_similar_ids(mark, num=num)
+        return self.get_marks(mark_ids=similar_ids)
+
+    def _precomputed_similar_ids(self, mark_id, *, num=10):
+        """Similar mark IDs from the mark_similar table, None if it can't answer
+
+        Marks changed since the table was refreshed are not answered, other
+        marks' lists may lag behind recent writes until the next refresh.
+        """
+        if num > self.precompute_similar:
+            return None
+        rows = self.dbconn.execute(
+                """SELECT similar_id FROM mark_similar
+                    WHERE mark_id = :mark_id
+                      AND NOT EXISTS (SELECT 1 FROM mark_changes
+                                       WHERE mark_id = :mark_id
+                                         AND change_id > (SELECT refresh_id FROM cache
+                                                           WHERE key = 'mark_similar'))
+                 ORDER BY rank
+                    LIMIT :num;""",
+                {'mark_id': mark_id, 'num': num}).fetchall()
+        return [row[0] for row in rows] or None
+
+    @metrics.timed('find_similar')
+    def find_similar_ids(self, marks, *, num=10):
+        """IDs of the marks most similar to each of `marks`, as one list per mark"""
+        return self._similarity_search().find_similar_many(marks, num=num)
+
+    def _similarity_search(self):
+        """The similarity index saved by the last refresh, mapped from disk when it changed
+
+        After writes, the last saved index is served until the background
+        refresh replaces it. It is only built here if no refresh has saved
+        one yet, and then mapped from the saved file like any other.
+        """
+        entry = self.cache.get_entry('similarity')
+        refresh_id = entry['refresh_id'] if entry else None
+        if entry and entry['change_id'] != refresh_id:
+            # Writes of this process notified it already, not those made before a restart.
+            SimilarityRefresher.for_db(self).notify_if_idle()
+        search = _similarity_indexes.get(self.dbfname)
+        if search is not None and search.change_id == refresh_id:
+            return search
+        if refresh_id is not None:
+            loaded = SimilaritySearch.load_if_valid(self.similarity_index_fname)
+            if loaded is not None and loaded.change_id == refresh_id:
+                search = loaded
+        if search is None:
+            print("Warning: No saved similarity index found", file=sys.stderr, flush=True)
+            # Leave the mark_similar table to the background refresh, it may take a while.
+            self._refresh_similarity_cache(precompute=False)
+            search = SimilaritySearch.load(self.similarity_index_fname)
+        _similarity_indexes[self.dbfname] = search
+        return search
 
     def async_update_similarity_cache(self):
-        def f(self):
-            db = BookmarkDB(self.dbfname, self.abs_url_prefix, stopwords=self.stopwords,
-                            ignore_hosts_in_search=self.ignore_hosts_in_search)
-            db._refresh_similarity_cache()
-        p = mp.Process(target=f, args=(self,))
-        p.start()
+        SimilarityRefresher.for_db(self).notify()
+
+    def update_similarity_cache(self):
+        """Bring the similarity cache up to date right away, e.g. from scripts"""
+        self._refresh_similarity_cache()
+
+    def similarity_refresh_status(self):
+        status = SimilarityRefresher.for_db(self).status()
+        status['change_id'] = self.cache.change_id()
+        return status
 
-    def _refresh_similarity_cache(self):
-        search = SimilaritySearch(self.stopwords, self.ignore_hosts_in_search)
-        search.load_corpus(self.get_marks())
-        self.cache.set('similarity', search.serialize())
+    @metrics.timed('similarity_refresh')
+    def _refresh_similarity_cache(self, *, precompute=True):
+        """Bring the similarity cache up to date, incrementally if possible
+
+        With `precompute`, the mark_similar table and the tag suggester are
+        refreshed afterwards.
+        """
+        change_id = self.cache.change_id()
+        entry = self.cache.get_entry('similarity')
+        search = None
+        if entry:
+            search = SimilaritySearch.load_if_valid(self.similarity_index_fname)
+            # The change log only covers writes after the cache entry's refresh_id.
+            if search is not None and not (search.change_id == entry['refresh_id'] and
+                                           search.can_update(self.stopwords, self.ignore_hosts_in_search)):
+                search = None
+
+        refit = search is None
+        if refit:
+            search = SimilaritySearch(self.stopwords, self.ignore_hosts_in_search)
+            search.load_corpus(list(self.iter_marks()))
+        elif search.change_id != change_id:
+            changed_ids = self.cache.changed_marks(since=entry['refresh_id'])
+            marks = list(self.iter_marks(mark_ids=changed_ids))
+            existing_ids = {m.id for m in marks}
+            search.update(marks, removed_ids=[id for id in changed_ids if id not in existing_ids])
+        if search.change_id != change_id:
+            # Write the index before marking it fresh, readers check that both agree.
+            search.save(self.similarity_index_fname, change_id)
+            self.cache.set('similarity', None, change_id=change_id)
+        if precompute:
+            self._refresh_similar_table(search, change_id, refit=refit)
+            if self.cache.refresh_id('tag_suggester') != change_id:
+                self._refresh_tag_suggester(change_id)
         return search
 
+    # Share of the marks that may change before all of mark_similar is scored again.
+    MAX_RESCORE_DRIFT = 0.02
+
+    def _refresh_similar_table(self, search, change_id, *, refit):
+        """Store the top precompute_similar neighbours of every mark in mark_similar
+
+        After a refit of the index, all marks are scored again. Otherwise only
+        marks that changed, lost a neighbour to a change, or rank a changed
+        mark above their current last neighbour are. The scores of the other
+        marks don't follow the shifting IDF weights, which only move as marks
+        change, so all marks are scored again once more than
+        MAX_RESCORE_DRIFT of them changed since all were last scored.
+        """
+        k = self.precompute_similar
+        entry = self.cache.get_entry('mark_similar')
+        if not k:
+            if entry:
+                self.dbconn.execute("DELETE FROM mark_similar")
+                self.cache.delete('mark_similar')
+                self.cache.delete('mark_similar_drift')
+            return
+        if entry and entry['refresh_id'] == change_id and entry['value'] == k:
+            return
+
+        rescore = refit or not entry or entry['value'] != k
+        if not rescore:
+            stale_ids = self.cache.changed_marks(since=entry['refresh_id'])
+            drift_entry = self.cache.get_entry('mark_similar_drift')
+            drift = (drift_entry['value'] if drift_entry else 0) + len(stale_ids)
+            rescore = drift > self.MAX_RESCORE_DRIFT * len(search.id_rows)
+        if rescore:
+            stale_ids = affected_ids = [id for id in search.db_ids if id is not None]
+            drift = 0
+        else:
+            affected_ids = self._similar_rows_affected_by(search, stale_ids, k)
+
+        rows = []
+        for start in range(0, len(affected_ids), 1000):
+            marks = list(self.iter_marks(mark_ids=affected_ids[start:start + 1000]))
+            for m, scored in zip(marks, search.find_similar_scored(marks, num=k)):
+                rows.extend((m.id, rank, similar_id, score) for rank, (similar_id, score) in enumerate(scored))
+
+        # Only write once everything is scored, so the DB isn't locked meanwhile.
+        cur = self.dbconn.cursor()
+        if rescore:
+            cur.execute("DELETE FROM mark_similar")
+        else:
+            cur.execute("DELETE FROM mark_similar WHERE mark_id IN (SELECT value FROM json_each(?))",
+                        (json.dumps(list(set(stale_ids) | set(affected_ids))),))
+        cur.executemany("INSERT INTO mark_similar VALUES (?, ?, ?, ?)", rows)
+        # Counted before the table is marked fresh, a crash in between only rescores sooner.
+        self.cache.set('mark_similar_drift', drift, change_id=change_id)
+        self.cache.set('mark_similar', k, change_id=change_id)
+
+    def _similar_rows_affected_by(self, search, changed_ids, k):
+        """IDs of the marks whose top `k` neighbours may differ after `changed_ids` changed"""
+        affected = {id for id in changed_ids if id in search.id_rows}
+        rows = self.dbconn.execute(
+                """SELECT DISTINCT mark_id FROM mark_similar
+                    WHERE similar_id IN (SELECT value FROM json_each(?))""",
+                (json.dumps(changed_ids),))
+        affected.update(row[0] for row in rows if row[0] in search.id_rows)
+
+        # Scores are symmetric, so a changed mark's scores tell which lists it enters.
+        thresholds = np.full(len(search.db_ids), -np.inf)
+        rows = self.dbconn.execute("""SELECT mark_id, min(score), count(*) FROM mark_similar
+                                       GROUP BY mark_id""")
+        for mark_id, last_score, count in rows:
+            if count >= k and mark_id in search.id_rows:
+                thresholds[search.id_rows[mark_id]] = last_score
+        changed_marks = list(self.iter_marks(mark_ids=[id for id in changed_ids if id in search.id_rows]))
+        for _, scores in search.score_many(changed_marks):
+            affected.update(search.db_ids[row] for row in np.flatnonzero(scores > thresholds))
+        return sorted(affected)
+
 
 class DBCache:
+    # Entries updated incrementally from the mark_changes log.
+    CHANGE_LOG_KEYS = ('similarity', 'mark_similar')
+
     def __init__(self, dbconn):
         self.dbconn = dbconn
 
-    def create_schema(self):
-        self.dbconn.executescript("""
-            CREATE TABLE cache(
-                key TEXT UNIQUE NOT NULL,                 -- cache key
-                value BLOB,                               -- cached value
-                change_id INTEGER NOT NULL DEFAULT 0,     -- incremented on any DB write
-                refresh_id INTEGER NOT NULL DEFAULT -1,   -- equals change_id if up to date
-
-                PRIMARY KEY (key)
-            );
-        """)
-
-    def invalidate_cursor(self, cur):
+    def invalidate_cursor(self, cur, mark_ids=()):
         cur.execute("UPDATE cache SET change_id = change_id + 1")
+        # The value of the 'version' entry is the time of the last write.
+        cur.execute("UPDATE cache SET value = ? WHERE key = 'version'", (time.time(),))
+        cur.executemany("""INSERT OR REPLACE INTO mark_changes
+                                SELECT ?, max(change_id) FROM cache""",
+                        [(id,) for id in mark_ids])
 
     def invalidate(self):
         cur = self.dbconn.cursor()
         self.invalidate_cursor(cur)
         self.dbconn.commit()
 
-    def set(self, key, value):
-        row = self.dbconn.execute("SELECT change_id FROM cache where key = ?", (key,)).fetchone()
-        current_change_id = row['change_id'] if row else None
+    def change_id(self):
+        return self.dbconn.execute("SELECT max(change_id) FROM cache").fetchone()[0] or 0
+
+    def version(self):
+        """(change_id, time of the last write or None), read by primary key"""
+        row = self.dbconn.execute("SELECT change_id, value FROM cache WHERE key = 'version'").fetchone()
+        return (row[0], row[1]) if row else (self.change_id(), None)
+
+    def refresh_id(self, key):
+        row = self.dbconn.execute("SELECT refresh_id FROM cache WHERE key = ?", (key,)).fetchone()
+        return row['refresh_id'] if row else None
+
+    def set(self, key, value, change_id=None):
+        """Store `value` as up to date with the DB state `change_id` (default: current state)
+
+        Pass the change_id read before computing `value`, so that writes
+        happening meanwhile leave the entry out of date.
+        """
+        if change_id is None:
+            change_id = self.change_id()
 
         cur = self.dbconn.cursor()
         cur.execute("""
-             INSERT INTO cache(key, value) VALUES (?, ?)
+             INSERT INTO cache(key, value, change_id, refresh_id) VALUES (?, ?, ?, ?)
              ON CONFLICT (key) DO
-             UPDATE SET value = excluded.value, refresh_id = ?
-             """, (key, value, current_change_id))
+             UPDATE SET value = excluded.value, refresh_id = excluded.refresh_id
+                  WHERE excluded.refresh_id >= cache.refresh_id  -- Don't let slow writers undo updates
+             """, (key, value, change_id, change_id))
+        if key in self.CHANGE_LOG_KEYS:
+            self._prune_change_log(cur)
+        self.dbconn.commit()
+
+    def delete(self, key):
+        cur = self.dbconn.cursor()
+        cur.execute("DELETE FROM cache WHERE key = ?", (key,))
+        if key in self.CHANGE_LOG_KEYS:
+            self._prune_change_log(cur)
         self.dbconn.commit()
 
+    def _prune_change_log(self, cur):
+        # Keep the changes that some entry still has to catch up with.
+        placeholders = ', '.join('?' * len(self.CHANGE_LOG_KEYS))
+        cur.execute(f"""DELETE FROM mark_changes
+                          WHERE change_id <= (SELECT min(refresh_id) FROM cache
+                                               WHERE key IN ({placeholders}))""", self.CHANGE_LOG_KEYS)
+
+    def get_entry(self, key):
+        """Return the cache entry, even if it's out of date"""
+        return self.dbconn.execute(
+            "SELECT value, change_id, refresh_id FROM cache WHERE key = ?", (key,)).fetchone()
+
+    def changed_marks(self, since):
+        """IDs of marks added, edited or deleted after change_id `since`"""
+        rows = self.dbconn.execute("SELECT mark_id FROM mark_changes WHERE change_id > ?", (since,))
+        return [row['mark_id'] for row in rows]
+
     def get(self, key):
         row = self.dbconn.execute(
             """SELECT value
@@ -415,58 +1366,581 @@ class DBCache:
         return row['value'] if row else None
 
 
+def _refresh_similarity_cache_process(db_args, db_kwargs):
+    db = BookmarkDB(*db_args, **db_kwargs)
+    db._refresh_similarity_cache()
+    db.close()
+
+
+class SimilarityRefresher:
+    """Long-lived background worker refreshing the similarity cache of one DB
+
+    Notifications of DB writes are coalesced: a refresh starts after no new
+    write was notified for `debounce` seconds, but no later than
+    `max_staleness` seconds after the first write waiting for it. Each refit
+    runs in a child process, so it doesn't stall request handling.
+
+    There is one refresher per database file and process, use for_db().
+    """
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def for_db(cls, db):
+        with cls._instances_lock:
+            refresher = cls._instances.get(db.dbfname)
+            # After a fork, the refresher's thread only exists in the parent.
+            if refresher is None or refresher.pid != os.getpid() or not refresher.thread.is_alive():
+                refresher = cls(db)
+                cls._instances[db.dbfname] = refresher
+        return refresher
+
+    def __init__(self, db):
+        self.dbfname = db.dbfname
+        self.db_args = (db.dbfname, db.abs_url_prefix)
+        self.db_kwargs = dict(stopwords=db._stopwords, stopword_languages=db.stopword_languages,
+                              ignore_hosts_in_search=db.ignore_hosts_in_search,
+                              precompute_similar=db.precompute_similar)
+        self.debounce = db.refresh_debounce
+        self.max_staleness = db.refresh_max_staleness
+        self.pid = os.getpid()
+
+        self.cond = threading.Condition()
+        self.queue_depth = 0          # Writes notified since the last refresh started
+        self.first_pending = None     # Time of the first of these writes
+        self.last_pending = None      # Time of the last of these writes
+        self.running = False
+        self.last_refresh = None      # Wall-clock time the last refresh finished
+        self.last_change_id = None    # DB change_id the last refresh brought the cache up to
+        self.last_error = None
+
+        self.thread = threading.Thread(target=self._run, name=f'similarity-refresh {self.dbfname}',
+                                       daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        with self.cond:
+            now = time.monotonic()
+            if not self.queue_depth:
+                self.first_pending = now
+            self.last_pending = now
+            self.queue_depth += 1
+            self.cond.notify()
+
+    def notify_if_idle(self):
+        """Like notify(), unless a refresh is already waiting or running"""
+        with self.cond:
+            if not self.queue_depth and not self.running:
+                self.notify()
+
+    def status(self):
+        with self.cond:
+            return dict(
+                queue_depth=self.queue_depth,
+                running=self.running,
+                last_refresh=self.last_refresh,
+                refreshed_change_id=self.last_change_id,
+                last_error=self.last_error,
+            )
+
+    def _wait_for_burst_end(self):
+        with self.cond:
+            while True:
+                if not self.queue_depth:
+                    self.cond.wait()
+                    continue
+                deadline = min(self.last_pending + self.debounce,
+                               self.first_pending + self.max_staleness)
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    self.queue_depth = 0
+                    self.running = True
+                    return
+                self.cond.wait(timeout)
+
+    def _run(self):
+        while True:
+            self._wait_for_burst_end()
+            try:
+                change_id, error = self._refresh()
+            except Exception as e:
+                # The next write retries, the thread must not die with `running` set.
+                change_id, error = self.last_change_id, f"Refresh failed: {e!r}"
+                print(f"Warning: Similarity refresh of {self.dbfname} failed: {e!r}", file=sys.stderr, flush=True)
+            with self.cond:
+                self.running = False
+                self.last_refresh = time.time()
+                self.last_change_id = change_id
+                self.last_error = error
+
+    def _refresh(self):
+        """Run one refresh process, return the refreshed change_id and an error message or None"""
+        # Imported once here, instead of in every forked refresh process.
+        import_similarity_modules()
+        p = mp.Process(target=_refresh_similarity_cache_process, args=(self.db_args, self.db_kwargs))
+        p.start()
+        p.join()
+
+        dbconn = sqlite3.connect(self.dbfname)
+        dbconn.row_factory = sqlite3.Row
+        try:
+            change_id = DBCache(dbconn).refresh_id('similarity')
+        finally:
+            dbconn.close()
+        return change_id, f"Refresh process exited with {p.exitcode}" if p.exitcode else None
+
+
+_ARRAY_FILE_ALIGNMENT = 64
+
+
+def _align(n):
+    return -(-n // _ARRAY_FILE_ALIGNMENT) * _ARRAY_FILE_ALIGNMENT
+
+
+def _save_array_file(fname, magic, version, arrays, header):
+    """Atomically (re)write a file of the numpy `arrays` by name, after a JSON `header`"""
+    layout, offset = {}, 0
+    for name, a in arrays.items():
+        layout[name] = (offset, a.dtype.str, len(a))
+        offset += _align(a.nbytes)
+    header = json.dumps(dict(header, arrays=layout)).encode('utf-8')
+    data_start = _align(len(magic) + 8 + len(header))
+
+    tmp_fname = f'{fname}.{os.getpid()}-{threading.get_ident()}.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(magic + struct.pack('<II', version, len(header)) + header)
+        for name, a in arrays.items():
+            f.seek(data_start + layout[name][0])
+            f.write(np.ascontiguousarray(a).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_fname, fname)
+
+
+def _load_array_file(fname, magic, version, description):
+    """Map a file written by _save_array_file()
+
+    Returns the mmap, the header, the arrays as read-only views into the
+    mmap and the offset of each array in it.
+    """
+    with open(fname, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    pos = len(magic) + 8
+    file_version, header_len = struct.unpack('<II', buf[len(magic):pos])
+    if buf[:len(magic)] != magic or file_version != version:
+        raise ValueError(f"{fname}: Not a {description} of version {version}")
+    header = json.loads(buf[pos:pos + header_len])
+    data_start = _align(pos + header_len)
+    offsets = {name: data_start + offset for name, (offset, _, _) in header['arrays'].items()}
+    arrays = {name: np.frombuffer(buf, dtype=dtype, count=length, offset=offsets[name])
+              for name, (_, dtype, length) in header['arrays'].items()}
+    return buf, header, arrays, offsets
+
+
+class _SortedVocabulary(Mapping):
+    """Read-only term -> column mapping over the sorted vocabulary of an index file
+
+    Terms are looked up by binary search in the file's pages, so no per-process
+    dict is built, only a list of every BLOCK-th term to start the search in
+    the right block. `buf` holds the UTF-8 encoded terms back to back, sorted,
+    starting at `offset`; `ends` are their end positions, `cols` their columns.
+    """
+    BLOCK = 16
+
+    class _Terms(Sequence):
+        def __init__(self, vocabulary):
+            self.v = vocabulary
+
+        def __len__(self):
+            return len(self.v.ends)
+
+        def __getitem__(self, i):
+            v = self.v
+            return v.buf[v.offset + (v.ends[i - 1] if i else 0):v.offset + v.ends[i]]
+
+    def __init__(self, buf, offset, ends, cols):
+        self.buf = buf
+        self.offset = offset
+        # memoryviews index into plain ints, faster than numpy scalars.
+        self.ends = memoryview(ends)
+        self.cols = memoryview(cols)
+        self.terms = self._Terms(self)
+        self.samples = [self.terms[i] for i in range(0, len(self.cols), self.BLOCK)]
+
+    def __len__(self):
+        return len(self.cols)
+
+    def __getitem__(self, term):
+        key = term.encode('utf-8')
+        lo = max(bisect.bisect_right(self.samples, key) - 1, 0) * self.BLOCK
+        hi = min(lo + self.BLOCK, len(self.cols))
+        i = bisect.bisect_left(self.terms, key, lo, hi)
+        if i == hi or self.terms[i] != key:
+            raise KeyError(term)
+        return self.cols[i]
+
+    def __iter__(self):
+        return (term.decode('utf-8') for term in self.terms)
+
+    def items(self):
+        return zip(self, self.cols)
+
+
+class _RowIds(Sequence):
+    """Read-only mark ID of each index row, None for removed rows, over an array of IDs or -1"""
+
+    def __init__(self, ids):
+        self.ids = memoryview(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, row):
+        id = self.ids[row]
+        return None if id < 0 else id
+
+
+class _IdRows(Mapping):
+    """Read-only mark ID -> index row mapping over arrays of sorted IDs and their rows"""
+
+    def __init__(self, ids, rows):
+        self.ids = memoryview(ids)
+        self.rows = memoryview(rows)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, id):
+        i = bisect.bisect_left(self.ids, id) if id is not None else len(self.ids)
+        if i == len(self.ids) or self.ids[i] != id:
+            raise KeyError(id)
+        return self.rows[i]
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def items(self):
+        return zip(self.ids, self.rows)
+
+
+class _ColumnIndex:
+    """TF-IDF vectors of one bookmark column, updatable document by document
+
+    Computes the same vectors as a TfidfVectorizer with default settings
+    (smooth idf, l2 norm), but keeps raw term counts and document frequencies
+    around, so single documents can be added or removed without tokenizing
+    the whole corpus again. IDF weights are recomputed lazily on first use
+    after a change.
+
+    Removed documents stay in the matrices as all-zero rows until the next
+    full refit; `drift()` measures how much of the index is such dead weight.
+
+    The arrays and the vocabulary may be read-only views of a memory-mapped
+    index file, they are copied before being modified.
+    """
+
+    def __init__(self, **vectorizer_kwargs):
+        self.vectorizer_kwargs = vectorizer_kwargs
+        self.vocabulary = {}                        # Term -> matrix column
+        self.df = np.zeros(0, dtype=np.int64)       # Document frequency of each term
+        self.alive = np.zeros(0, dtype=bool)        # False for removed rows
+        # Raw term counts, as CSR matrix arrays
+        self.indptr = np.zeros(1, dtype=np.int32)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.counts = np.zeros(0, dtype=np.float64)
+        self._analyzer = None
+        self._idf = None
+        self._tfidf = None
+
+    @property
+    def analyzer(self):
+        if self._analyzer is None:
+            from sklearn.feature_extraction.text import TfidfVectorizer
+            self._analyzer = TfidfVectorizer(**self.vectorizer_kwargs).build_analyzer()
+        return self._analyzer
+
+    def append(self, texts):
+        if not isinstance(self.vocabulary, dict):
+            self.vocabulary = dict(self.vocabulary.items())
+        indptr, indices, counts = [], [], []
+        for text in texts:
+            for term, count in collections.Counter(self.analyzer(text or '')).items():
+                indices.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+                counts.append(count)
+            indptr.append(len(indices))
+
+        indices = np.array(indices, dtype=np.int32)
+        self.df = np.concatenate([self.df, np.zeros(len(self.vocabulary) - len(self.df), dtype=np.int64)])
+        self.df += np.bincount(indices, minlength=len(self.vocabulary))
+        self.alive = np.concatenate([self.alive, np.ones(len(indptr), dtype=bool)])
+        self.indptr = np.concatenate([self.indptr, self.indptr[-1] + np.array(indptr, dtype=np.int32)])
+        self.indices = np.concatenate([self.indices, indices])
+        self.counts = np.concatenate([self.counts, np.array(counts, dtype=np.float64)])
+        self._idf = self._tfidf = None
+
+    def remove(self, rows):
+        if len(rows):
+            self.df = self.df.copy()
+            self.alive = self.alive.copy()
+        for row in rows:
+            self.df[self.indices[self.indptr[row]:self.indptr[row + 1]]] -= 1
+            self.alive[row] = False
+        self._idf = self._tfidf = None
+
+    def drift(self):
+        if not len(self.alive):
+            return 0.0
+        dead_rows = 1 - np.count_nonzero(self.alive) / len(self.alive)
+        dead_terms = np.count_nonzero(self.df == 0) / max(len(self.df), 1)
+        return max(dead_rows, dead_terms)
+
+    def idf(self):
+        if self._idf is None:
+            num_docs = np.count_nonzero(self.alive)
+            self._idf = np.log((1 + num_docs) / (1 + self.df)) + 1
+        return self._idf
+
+    def tfidf(self):
+        """Normalized TF-IDF matrix, one row per document"""
+        if self._tfidf is None:
+            from scipy.sparse import csr_matrix
+            row_alive = np.repeat(self.alive, np.diff(self.indptr))
+            data = self.counts * self.idf()[self.indices] * row_alive
+            shape = (len(self.alive), len(self.vocabulary))
+            self._tfidf = self._normalize(csr_matrix((data, self.indices, self.indptr), shape=shape))
+        return self._tfidf
+
+    def transform(self, texts):
+        """Normalized TF-IDF matrix of `texts`, as TfidfVectorizer.transform()"""
+        from scipy.sparse import csr_matrix
+        indptr, indices, counts = [0], [], []
+        for text in texts:
+            for term, count in collections.Counter(self.analyzer(text or '')).items():
+                col = self.vocabulary.get(term)
+                # Terms of removed documents only are unknown to a full refit.
+                if col is not None and self.df[col]:
+                    indices.append(col)
+                    counts.append(count)
+            indptr.append(len(indices))
+        indices = np.array(indices, dtype=np.int32)
+        data = np.array(counts, dtype=np.float64) * self.idf()[indices]
+        shape = (len(texts), len(self.vocabulary))
+        return self._normalize(csr_matrix((data, indices, indptr), shape=shape))
+
+    @staticmethod
+    def _normalize(matrix):
+        from sklearn.preprocessing import normalize
+        # sklearn refuses empty matrices, e.g. of an empty corpus.
+        return normalize(matrix) if min(matrix.shape) else matrix
+
+
 class SimilaritySearch:
+    """TF-IDF based search for bookmarks similar to a given one
+
+    load_corpus() fits the index to all marks, update() adds, replaces or
+    removes single marks incrementally. Both yield the same similarity scores
+    (up to floating point rounding, well within 1e-9), ties may be ordered
+    differently. Removed marks and their vocabulary stay in the index as dead
+    weight, so can_update() asks for a full refit once that exceeds
+    MAX_DRIFT, or after REFIT_INTERVAL seconds.
+
+    save() writes the index to a file of its own: a small JSON header
+    followed by the raw CSR arrays, the precomputed TF-IDF weights, IDF
+    weights and postings matrix, the sorted vocabulary and the mark IDs.
+    load() memory-maps that file read-only and builds nothing per process:
+    vocabulary and ID lookups are binary searches in the mapped pages. All
+    worker processes of a server thus share one copy of each index in the
+    page cache. A new version is written to a new file that atomically
+    replaces the old one; processes map it once they see the DB's change_id
+    advance, and the old one is freed when the last process lets go of it.
+
+    Memory use is therefore bounded by the size of the index files, counted
+    once however many workers there are, plus per worker and query batch the
+    dense score matrix of at most MAX_SCORES float64 entries (128 MiB, or
+    8 bytes per mark for a single query). Only the background refresh builds
+    private copies, in a short-lived child process, to update the index.
+    """
+    WEIGHTS = dict(tags=0.15, title=0.50, note=0.25, host=0.10)
+    MAX_SCORES = 2 ** 24          # Entries of the dense score matrix per batch of queries
+    FILE_MAGIC = b'KB3SIMIX'
+    FORMAT_VERSION = 4
+    REFIT_INTERVAL = 24 * 3600
+    MAX_DRIFT = 0.2
+
     def __init__(self, stopwords, ignore_hosts):
         self.stopwords = stopwords
         self.ignore_hosts = ignore_hosts
-        self.vectorizers = dict()  # Vectorizer for each column
-        self.db_vectors = dict()   # Sparse Matrix of documents/terms
-        self.db_ids = []           # Map from matrix indices to Mark IDs
+        self.columns = dict(
+            tags=_ColumnIndex(),
+            title=_ColumnIndex(stop_words=stopwords),
+            note=_ColumnIndex(stop_words=stopwords),
+            host=_ColumnIndex(token_pattern='.*'),
+        )
+        self.db_ids = []           # Map from matrix indices to Mark IDs, None for removed marks
+        self.id_rows = {}          # Map from Mark IDs to matrix indices
+        self.fitted_at = time.time()
+        self.change_id = None      # DB change_id the index was saved at
+        self._postings = None
+
+    def save(self, fname, change_id):
+        """Atomically (re)write the index file, as of DB state `change_id`"""
+        self.change_id = change_id
+        db_ids = np.array([-1 if id is None else id for id in self.db_ids], dtype=np.int64)
+        id_order = np.argsort(db_ids, kind='stable')
+        id_order = id_order[db_ids[id_order] >= 0]
+        postings = self.postings()
+        arrays = {
+            'db_ids': db_ids,
+            'id_rows.ids': db_ids[id_order],
+            'id_rows.rows': id_order.astype(np.int64),
+            'postings.indptr': postings.indptr,
+            'postings.indices': postings.indices,
+            'postings.data': postings.data,
+        }
+        for name, index in self.columns.items():
+            # Sorted as UTF-8, which is the same order as sorting by code points.
+            vocabulary = sorted((t.encode('utf-8'), col) for t, col in index.vocabulary.items())
+            arrays.update({
+                name + '.indptr': index.indptr,
+                name + '.indices': index.indices,
+                name + '.counts': index.counts,
+                name + '.tfidf': index.tfidf().data,
+                name + '.df': index.df,
+                name + '.idf': index.idf(),
+                name + '.alive': index.alive,
+                name + '.terms': np.frombuffer(b''.join(t for t, _ in vocabulary), dtype=np.uint8),
+                name + '.term_ends': np.cumsum([len(t) for t, _ in vocabulary], dtype=np.int64),
+                name + '.term_cols': np.array([col for _, col in vocabulary], dtype=np.int64),
+            })
+
+        _save_array_file(fname, self.FILE_MAGIC, self.FORMAT_VERSION, arrays, dict(
+            change_id=change_id,
+            fitted_at=self.fitted_at,
+            stopwords=list(self.stopwords or ()),
+            ignore_hosts=list(self.ignore_hosts),
+        ))
 
-    def serialize(self):
-        return pickle.dumps(self)
+    @classmethod
+    @metrics.timed('similarity_load')
+    def load(cls, fname):
+        from scipy.sparse import csr_matrix
+        buf, header, arrays, offsets = _load_array_file(fname, cls.FILE_MAGIC, cls.FORMAT_VERSION,
+                                                        "similarity index")
+
+        search = cls(header['stopwords'] or None, header['ignore_hosts'])
+        search.fitted_at = header['fitted_at']
+        search.change_id = header['change_id']
+        search.db_ids = _RowIds(arrays['db_ids'])
+        search.id_rows = _IdRows(arrays['id_rows.ids'], arrays['id_rows.rows'])
+        for name, index in search.columns.items():
+            index.indptr = arrays[name + '.indptr']
+            index.indices = arrays[name + '.indices']
+            index.counts = arrays[name + '.counts']
+            index.df = arrays[name + '.df']
+            index._idf = arrays[name + '.idf']
+            index.alive = arrays[name + '.alive']
+            index.vocabulary = _SortedVocabulary(buf, offsets[name + '.terms'],
+                                                 arrays[name + '.term_ends'], arrays[name + '.term_cols'])
+            shape = (len(index.alive), len(index.vocabulary))
+            index._tfidf = csr_matrix((arrays[name + '.tfidf'], index.indices, index.indptr), shape=shape)
+        num_terms = sum(len(search.columns[name].vocabulary) for name in cls.WEIGHTS)
+        search._postings = csr_matrix((arrays['postings.data'], arrays['postings.indices'], arrays['postings.indptr']),
+                                      shape=(num_terms, len(search.db_ids)))
+        return search
 
     @classmethod
-    def deserialize(cls, s):
-        return pickle.loads(s)
+    def load_if_valid(cls, fname):
+        """Like load(), but return None if the file is missing or unreadable"""
+        try:
+            return cls.load(fname)
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"Warning: Ignoring similarity index: {e}", file=sys.stderr, flush=True)
+            return None
 
     def load_corpus(self, all_marks):
-        marks_data = [self._mark_to_dict(m) for m in all_marks]
-        self._load_column_corpus(marks_data, 'tags')
-        self._load_column_corpus(marks_data, 'title', stop_words=self.stopwords)
-        self._load_column_corpus(marks_data, 'note', stop_words=self.stopwords)
-        self._load_column_corpus(marks_data, 'host', token_pattern='.*')
-        self.db_ids = [m['id'] for m in marks_data]
+        self.__init__(self.stopwords, self.ignore_hosts)
+        self.update(all_marks)
+
+    def update(self, marks, removed_ids=()):
+        """Add or replace `marks` and remove the marks `removed_ids` from the index"""
+        if not isinstance(self.db_ids, list):
+            self.db_ids = list(self.db_ids)
+            self.id_rows = dict(self.id_rows.items())
+        marks_data = [self._mark_to_dict(m) for m in marks]
+        stale_ids = set(removed_ids) | {m['id'] for m in marks_data}
+        stale_rows = [self.id_rows.pop(id) for id in stale_ids if id in self.id_rows]
+        for column, index in self.columns.items():
+            index.remove(stale_rows)
+            index.append([m[column] for m in marks_data])
+        for row in stale_rows:
+            self.db_ids[row] = None
+        for m in marks_data:
+            self.id_rows[m['id']] = len(self.db_ids)
+            self.db_ids.append(m['id'])
+        self._postings = None
+
+    def can_update(self, stopwords, ignore_hosts):
+        """Check whether update() may be used instead of a full refit"""
+        return (list(self.stopwords or ()) == list(stopwords or ()) and
+                list(self.ignore_hosts) == list(ignore_hosts) and
+                time.time() - self.fitted_at < self.REFIT_INTERVAL and
+                all(index.drift() <= self.MAX_DRIFT for index in self.columns.values()))
 
     def find_similar_ids(self, mark, *, num=10):
-        mark_id = getattr(mark, 'id', None)
-        mark_data = self._mark_to_dict(mark)
-        sim = (
-            0.15 * self._similarity(mark_data, 'tags') +
-            0.50 * self._similarity(mark_data, 'title') +
-            0.25 * self._similarity(mark_data, 'note') +
-            0.10 * self._similarity(mark_data, 'host')
-        )
-        best_doc_indices = sim.argsort()
-        best_mark_ids = [self.db_ids[i] for i in best_doc_indices[:-num-1:-1]]
-        return [bm_id for bm_id in best_mark_ids if bm_id != mark_id][:num]
-
-    def _load_column_corpus(self, marks, column, **kwargs):
-        db_texts = [m[column] for m in marks]
-        self.vectorizers[column] = TfidfVectorizer(**kwargs)
-        self.db_vectors[column] = self.vectorizers[column].fit_transform(db_texts)
-
-    def _similarity(self, mark, column, **kwargs):
-        vectorizer = self.vectorizers[column]
-        db_vec = self.db_vectors[column]
-        mark_text = mark[column] or ''
-        mark_vec = vectorizer.transform([mark_text])
-        return linear_kernel(db_vec, mark_vec).flatten()
+        return self.find_similar_many([mark], num=num)[0]
+
+    def find_similar_many(self, marks, *, num=10):
+        """IDs of the `num` marks most similar to each of `marks`, best first"""
+        return [[id for id, _ in scored] for scored in self.find_similar_scored(marks, num=num)]
+
+    def find_similar_scored(self, marks, *, num=10):
+        """Like find_similar_many(), but as (id, score) pairs"""
+        return [self._top(scores, num) for _, scores in self.score_many(marks)]
+
+    def score_many(self, marks):
+        """Yield each of `marks` with its similarity to every row of the index
+
+        The weighted TF-IDF vectors of all queries are scored against the
+        whole corpus in one sparse matrix product per batch. Removed rows and
+        the mark itself score -inf.
+        """
+        from scipy.sparse import hstack
+        postings = self.postings()
+        dead_rows = ~self.columns['tags'].alive
+        batch_size = max(1, self.MAX_SCORES // max(len(self.db_ids), 1))
+        for start in range(0, len(marks), batch_size):
+            batch = marks[start:start + batch_size]
+            batch_data = [self._mark_to_dict(m) for m in batch]
+            with metrics.timer('tfidf'):
+                queries = hstack([weight * self.columns[column].transform([m[column] or '' for m in batch_data])
+                                  for column, weight in self.WEIGHTS.items()], format='csr')
+                scores = (queries @ postings).toarray()
+            scores[:, dead_rows] = -np.inf
+            for m, row_scores in zip(batch_data, scores):
+                if m.get('id') in self.id_rows:
+                    row_scores[self.id_rows[m['id']]] = -np.inf
+            yield from zip(batch, scores)
+
+    def _top(self, scores, num):
+        num = min(num, len(scores))
+        if num <= 0:
+            return []
+        best = np.argpartition(scores, len(scores) - num)[-num:]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return [(self.db_ids[i], float(scores[i])) for i in best if scores[i] > -np.inf]
+
+    def postings(self):
+        """TF-IDF matrices of all columns side by side and transposed, one row per term"""
+        if self._postings is None:
+            from scipy.sparse import hstack
+            stacked = hstack([self.columns[column].tfidf() for column in self.WEIGHTS], format='csr')
+            self._postings = stacked.T.tocsr()
+        return self._postings
 
     def _mark_to_dict(self, mark):
-        m = mark.__dict__.copy()
-        m['tags'] = ' '.join(m['_tags'] or '')
-        del m['_tags']
+        """The indexed columns of a Bookmark or MarkRow"""
+        tags = mark.tags if isinstance(mark.tags, str) else ' '.join(mark.tags or ())
+        m = dict(id=mark.id, title=mark.title, url=mark.url, note=mark.note, tags=tags)
         h = re.match(r'[^/]*///*([^/]*)', m['url'] or '')
         m['host'] = h.group(1) if h else ''
         for ih in self.ignore_hosts: